@@ -0,0 +1,78 @@
+"""
+Off-loop executor for CPU-bound pandas/openpyxl work
+
+Request handlers are async, so heavy DataFrame work run inline freezes the event loop
+for every other request on the worker. CPUExecutor runs those stages on a spawn-started
+process pool, so their Python-level work does not compete with the event loop for the GIL
+(or, when opted in, on a thread pool, which skips pickling the arguments), and sheds load
+with 503 + Retry-After once too many are queued.
+"""
+
+import asyncio
+import functools
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from fastapi import HTTPException
+
+# Executor configuration (override via environment)
+CPU_EXECUTOR_KIND = os.getenv("CPU_EXECUTOR_KIND", "process")  # 'process' (pickles every argument) or 'thread' (shares the GIL)
+CPU_EXECUTOR_WORKERS = int(os.getenv("CPU_EXECUTOR_WORKERS", str(min(os.cpu_count() or 2, 4))))
+CPU_EXECUTOR_MAX_PENDING = int(os.getenv("CPU_EXECUTOR_MAX_PENDING", "16"))  # Running + queued tasks
+CPU_EXECUTOR_RETRY_AFTER = int(os.getenv("CPU_EXECUTOR_RETRY_AFTER", "5"))  # Seconds, sent on 503
+
+class CPUExecutor:
+    """Bounded wrapper around a process or thread pool for use from async handlers"""
+
+    def __init__(self, kind: str, max_workers: int, max_pending: int, retry_after: int):
+        if kind not in ("process", "thread"):
+            raise ValueError(f"Unknown executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self._executor: Executor = None
+        self._pending = 0  # Only touched from the event loop thread
+
+    def _get_executor(self) -> Executor:
+        # Created lazily so importing the app never forks worker processes
+        if self._executor is None:
+            if self.kind == "process":
+                # Spawned, not forked: a child forked while an aiosqlite or job queue thread holds a
+                # lock would inherit that lock held, with no thread left to release it
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="cpu")
+        return self._executor
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def check_capacity(self):
+        """Raise 503 when the queue is saturated (lets streaming responses fail before they start)"""
+        if self._pending >= self.max_pending:
+            raise HTTPException(
+                status_code=503,
+                detail="Server is busy processing other requests. Please retry shortly.",
+                headers={"Retry-After": str(self.retry_after)},
+            )
+
+    async def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) off the event loop; raise 503 when the queue is saturated"""
+        self.check_capacity()
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), functools.partial(func, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+cpu_executor = CPUExecutor(CPU_EXECUTOR_KIND, CPU_EXECUTOR_WORKERS, CPU_EXECUTOR_MAX_PENDING, CPU_EXECUTOR_RETRY_AFTER)
@@ -1,31 +1,159 @@
 import { useState, useEffect } from 'react'
-import { Card, Alert, Button, Table, Row, Col, Spinner } from 'react-bootstrap'
+import { Card, Alert, Button, Table, Row, Col, Spinner, Form, Pagination } from 'react-bootstrap'
 import { FiSearch, FiDownload, FiCheckCircle, FiAlertTriangle } from 'react-icons/fi'
 import toast from 'react-hot-toast'
-import { getAuditTrail, exportAuditTrail, downloadFile, AuditTrailItem } from '../services/api'
+import { getAuditTrailPage, exportAuditTrail, downloadFile, AuditTrailItem, AuditTrailSummary, PaginationInfo } from '../services/api'
+
+// Only the columns the table shows are requested
+const AUDIT_TABLE_COLUMNS = [
+  'account_code', 'current_year_actual', 'budget', 'prior_year_actual', 'fund_code', 'function_code', 'object_code',
+  'statement_type', 'statement_line_code', 'statement_line_description', 'mapping_method', 'unmapped_accounts'
+].join(',')
+
+interface AuditFilters {
+  unmapped: string
+  gasb_category: string
+  fund_code: string
+  function_code: string
+  statement_line_code: string
+  rollup_applied: string
+}
+
+const EMPTY_FILTERS: AuditFilters = {
+  unmapped: '',
+  gasb_category: '',
+  fund_code: '',
+  function_code: '',
+  statement_line_code: '',
+  rollup_applied: ''
+}
 
 export default function AuditSection() {
   const [auditData, setAuditData] = useState<AuditTrailItem[]>([])
+  const [summary, setSummary] = useState<AuditTrailSummary | null>(null)
   const [loading, setLoading] = useState(false)
+  const [pageLoading, setPageLoading] = useState(false)
   const [exporting, setExporting] = useState(false)
 
+  // Paging, sorting and filtering all happen on the server
+  const [currentPage, setCurrentPage] = useState(1)
+  const [pageSize, setPageSize] = useState(100)
+  const [pagination, setPagination] = useState<PaginationInfo>({
+    page: 1,
+    page_size: 100,
+    total_items: 0,
+    total_pages: 0
+  })
+  const [sort, setSort] = useState('row')
+  const [order, setOrder] = useState<'asc' | 'desc'>('asc')
+  const [filterInput, setFilterInput] = useState<AuditFilters>(EMPTY_FILTERS)
+  const [filters, setFilters] = useState<AuditFilters>(EMPTY_FILTERS)
+  const [loaded, setLoaded] = useState(false)
+
   useEffect(() => {
     loadAuditData()
-  }, [])
+  }, [currentPage, pageSize, sort, order, filters])
 
   const loadAuditData = async () => {
-    setLoading(true)
+    // The first load (which may rebuild the stored audit trail) blanks the section; later pages keep the table
+    if (!loaded) {
+      setLoading(true)
+    } else {
+      setPageLoading(true)
+    }
     try {
-      const response = await getAuditTrail()
+      const response = await getAuditTrailPage({
+        page: currentPage,
+        page_size: pageSize,
+        sort,
+        order,
+        columns: AUDIT_TABLE_COLUMNS,
+        unmapped: filters.unmapped === '' ? undefined : filters.unmapped === 'true',
+        gasb_category: filters.gasb_category.trim(),
+        fund_code: filters.fund_code.trim(),
+        function_code: filters.function_code.trim(),
+        statement_line_code: filters.statement_line_code.trim(),
+        rollup_applied: filters.rollup_applied === '' ? undefined : filters.rollup_applied === 'true'
+      })
       if (response.success && response.audit_data) {
         setAuditData(response.audit_data)
+        setSummary(response.summary)
+        setPagination(response.pagination)
       }
     } catch (error) {
       toast.error('Error loading audit data')
       console.error('Error loading audit data:', error)
     } finally {
+      setLoaded(true)
       setLoading(false)
+      setPageLoading(false)
+    }
+  }
+
+  const handleSort = (column: string) => {
+    if (sort === column) {
+      setOrder(order === 'asc' ? 'desc' : 'asc')
+    } else {
+      setSort(column)
+      setOrder('asc')
+    }
+    setCurrentPage(1)
+  }
+
+  const sortIndicator = (column: string) => sort === column ? (order === 'asc' ? ' ▲' : ' ▼') : ''
+
+  const handleApplyFilters = () => {
+    setFilters(filterInput)
+    setCurrentPage(1)
+  }
+
+  const handleClearFilters = () => {
+    setFilterInput(EMPTY_FILTERS)
+    setFilters(EMPTY_FILTERS)
+    setCurrentPage(1)
+  }
+
+  const handleKeyPress = (e: React.KeyboardEvent) => {
+    if (e.key === 'Enter') {
+      handleApplyFilters()
+    }
+  }
+
+  // Generate page numbers for pagination
+  const generatePageNumbers = () => {
+    const pages = []
+    const totalPages = pagination.total_pages
+    const current = pagination.page
+    
+    // Always show first page
+    if (totalPages > 0) {
+      pages.push(1)
     }
+    
+    // Show pages around current page
+    const start = Math.max(2, current - 2)
+    const end = Math.min(totalPages - 1, current + 2)
+    
+    if (start > 2) {
+      pages.push('...')
+    }
+    
+    for (let i = start; i <= end; i++) {
+      if (i !== 1 && i !== totalPages) {
+        pages.push(i)
+      }
+    }
+    
+    if (end < totalPages - 1) {
+      pages.push('...')
+    }
+    
+    // Always show last page
+    if (totalPages > 1) {
+      pages.push(totalPages)
+    }
+    
+    return pages
   }
 
   const handleExportAuditTrail = async () => {
@@ -44,138 +172,33 @@ export default function AuditSection() {
   }
 
   const getValidationStatus = () => {
-    if (!auditData || auditData.length === 0) return { 
+    if (!summary || summary.total_records === 0) return { 
       status: 'warning', 
-      message: 'No data available',
-      totalCount: 0,
-      mappedCount: 0,
-      unmappedCount: 0,
-      unknownTotal: 0,
-      unknownCount: 0
+      message: 'No data available'
     }
     
-    // Count mapped vs unmapped accounts
-    const unmappedCount = auditData.filter(item => item.unmapped_accounts).length
-    const totalCount = auditData.length
-    const mappedCount = totalCount - unmappedCount
-    
-    // Calculate totals for balance validation
-    let totalDebits = 0
-    let totalCredits = 0
-    let unknownDebits = 0
-    let unknownCredits = 0
-    let unknownCount = 0
-    
-    auditData.forEach(item => {
-      const amount = Math.abs(item.current_year_actual)
-      const teaCategory = item.tea_category.toLowerCase()
-      const gasbCategory = item.gasb_category.toLowerCase()
-      
-      // Only count truly unmapped accounts as unknown
-      if (item.unmapped_accounts) {
-        unknownCount++
-        if (item.current_year_actual > 0) {
-          totalDebits += amount
-          unknownDebits += amount
-        } else {
-          totalCredits += amount
-          unknownCredits += amount
-        }
-      } else {
-        // For mapped accounts, determine if this account type is normally a debit or credit account
-        // Check TEA category first, then GASB category as fallback
-        if (isDebitAccount(teaCategory) || isDebitAccount(gasbCategory)) {
-          totalDebits += amount
-        } else if (isCreditAccount(teaCategory) || isCreditAccount(gasbCategory)) {
-          totalCredits += amount
-        } else {
-          // If we can't determine debit/credit for a mapped account, 
-          // treat it as debit if positive, credit if negative
-          if (item.current_year_actual > 0) {
-            totalDebits += amount
-          } else {
-            totalCredits += amount
-          }
-        }
-      }
-    })
-    
-    const difference = Math.abs(totalDebits - totalCredits)
-    const totalUnknown = unknownDebits + unknownCredits
+    // Counts and the unmapped balance come from the server, over the whole audit trail
+    const totalCount = summary.total_records
+    const mappedCount = summary.mapped_records
+    const unmappedCount = summary.unmapped_records
     
     let message = ''
     if (unmappedCount === 0) {
       message = `All ${totalCount} accounts are properly mapped`
-    } else if (unmappedCount < totalCount * 0.1) {
-      message = `${mappedCount}/${totalCount} accounts mapped (${unmappedCount} unmapped)`
     } else {
       message = `${mappedCount}/${totalCount} accounts mapped (${unmappedCount} unmapped)`
     }
     
-    if (totalUnknown > 0) {
-      message += ` | Unknown: $${totalUnknown.toLocaleString()} (${unknownCount} accounts)`
+    if (summary.unmapped_amount > 0) {
+      message += ` | Unknown: $${summary.unmapped_amount.toLocaleString()} (${unmappedCount} accounts)`
     }
     
     let status = 'success'
     if (unmappedCount > 0) {
       status = unmappedCount < totalCount * 0.1 ? 'warning' : 'danger'
     }
-    // if (difference > 1) {
-    //   status = 'danger'
-    // }
     
-    return { 
-      status, 
-      message,
-      unknownTotal: totalUnknown,
-      unknownCount,
-      unmappedCount,
-      mappedCount,
-      totalCount
-    }
-  }
-
-  const isDebitAccount = (category: string) => {
-    // Assets, Expenses, and Expenditures are debit accounts
-    return category.includes('asset') || 
-           category.includes('expense') || 
-           category.includes('expenditure') ||
-           category.includes('cash') ||
-           category.includes('receivable') ||
-           category.includes('inventory') ||
-           category.includes('capital_asset') ||
-           category.includes('current_asset') ||
-           category.includes('deferred_outflow') ||
-           category.includes('program_expense') ||
-           category.includes('general_expense') ||
-           category === 'assets' ||
-           category === 'expenditures/expenses' ||
-           category === 'other_uses' ||
-           category === 'program_expenses' ||
-           category === 'general_expenses'
-  }
-
-  const isCreditAccount = (category: string) => {
-    // Liabilities, Equity, Revenues, and Fund Balances are credit accounts
-    return category.includes('liability') || 
-           category.includes('equity') || 
-           category.includes('revenue') ||
-           category.includes('payable') ||
-           category.includes('debt') ||
-           category.includes('fund_balance') ||
-           category.includes('net_position') ||
-           category.includes('current_liability') ||
-           category.includes('general_revenue') ||
-           category.includes('restricted_net_position') ||
-           category.includes('other resources') ||
-           category.includes('non-operating') ||
-           category === 'liabilities' ||
-           category === 'revenues' ||
-           category === 'other resources/non-operating revenues' ||
-           category === 'fund balances/net position' ||
-           category === 'other_resources' ||
-           category === 'program_revenues' ||
-           category === 'general_revenues'
+    return { status, message }
   }
 
   const validation = getValidationStatus()
@@ -242,15 +265,14 @@ export default function AuditSection() {
           <Card>
             <Card.Body>
               <h6 className="mb-3">Summary</h6>
-              <p className="mb-1"><strong>Total Records:</strong> {validation?.totalCount?.toLocaleString() || '0'}</p>
-              <p className="mb-1"><strong>Mapped:</strong> {validation?.mappedCount?.toLocaleString() || '0'}</p>
-              <p className="mb-1"><strong>Unmapped:</strong> {validation?.unmappedCount?.toLocaleString() || '0'}</p>
-              <p className="mb-1"><strong>Statement Types:</strong> {new Set(auditData.map(item => item.statement_type)).size}</p>
-              {validation?.unknownTotal > 0 && (
+              <p className="mb-1"><strong>Total Records:</strong> {summary?.total_records?.toLocaleString() || '0'}</p>
+              <p className="mb-1"><strong>Mapped:</strong> {summary?.mapped_records?.toLocaleString() || '0'}</p>
+              <p className="mb-1"><strong>Unmapped:</strong> {summary?.unmapped_records?.toLocaleString() || '0'}</p>
+              {summary && summary.unmapped_amount > 0 && (
                 <p className="mb-0">
                   <strong className="text-warning">Unknown Balances:</strong> 
                   <br />
-                  <span className="text-warning">${validation.unknownTotal.toLocaleString()} ({validation.unknownCount} accounts)</span>
+                  <span className="text-warning">${summary.unmapped_amount.toLocaleString()} ({summary.unmapped_records} accounts)</span>
                 </p>
               )}
             </Card.Body>
@@ -264,7 +286,7 @@ export default function AuditSection() {
                   variant="primary" 
                   size="sm"
                   onClick={handleExportAuditTrail}
-                  disabled={exporting || auditData.length === 0}
+                  disabled={exporting || !summary || summary.total_records === 0}
                 >
                   <FiDownload className="me-2" />
                   {exporting ? 'Exporting...' : 'Download CSV'}
@@ -285,27 +307,125 @@ export default function AuditSection() {
           <h6 className="mb-0">Detailed Audit Trail</h6>
         </Card.Header>
         <Card.Body>
+          {/* Filters */}
+          <Row className="mb-3 g-2">
+            <Col md={2}>
+              <Form.Select
+                size="sm"
+                value={filterInput.unmapped}
+                onChange={(e) => setFilterInput({ ...filterInput, unmapped: e.target.value })}
+              >
+                <option value="">All statuses</option>
+                <option value="false">Mapped</option>
+                <option value="true">Unmapped</option>
+              </Form.Select>
+            </Col>
+            <Col md={2}>
+              <Form.Control
+                size="sm"
+                placeholder="GASB category"
+                value={filterInput.gasb_category}
+                onChange={(e) => setFilterInput({ ...filterInput, gasb_category: e.target.value })}
+                onKeyPress={handleKeyPress}
+              />
+            </Col>
+            <Col md={1}>
+              <Form.Control
+                size="sm"
+                placeholder="Fund"
+                value={filterInput.fund_code}
+                onChange={(e) => setFilterInput({ ...filterInput, fund_code: e.target.value })}
+                onKeyPress={handleKeyPress}
+              />
+            </Col>
+            <Col md={1}>
+              <Form.Control
+                size="sm"
+                placeholder="Function"
+                value={filterInput.function_code}
+                onChange={(e) => setFilterInput({ ...filterInput, function_code: e.target.value })}
+                onKeyPress={handleKeyPress}
+              />
+            </Col>
+            <Col md={2}>
+              <Form.Control
+                size="sm"
+                placeholder="Statement line code"
+                value={filterInput.statement_line_code}
+                onChange={(e) => setFilterInput({ ...filterInput, statement_line_code: e.target.value })}
+                onKeyPress={handleKeyPress}
+              />
+            </Col>
+            <Col md={2}>
+              <Form.Select
+                size="sm"
+                value={filterInput.rollup_applied}
+                onChange={(e) => setFilterInput({ ...filterInput, rollup_applied: e.target.value })}
+              >
+                <option value="">Any roll-up</option>
+                <option value="true">Roll-up applied</option>
+                <option value="false">No roll-up</option>
+              </Form.Select>
+            </Col>
+            <Col md={2} className="d-flex">
+              <Button variant="outline-secondary" size="sm" className="me-2" onClick={handleApplyFilters}>
+                Filter
+              </Button>
+              <Button variant="outline-secondary" size="sm" onClick={handleClearFilters}>
+                Clear
+              </Button>
+            </Col>
+          </Row>
+          
+          <Row className="mb-3">
+            <Col>
+              {pagination.total_items > 0 && (
+                <small className="text-muted">
+                  Showing {((pagination.page - 1) * pagination.page_size) + 1} to {Math.min(pagination.page * pagination.page_size, pagination.total_items)} of {pagination.total_items.toLocaleString()} records
+                  {pageLoading && <Spinner animation="border" size="sm" className="ms-2" />}
+                </small>
+              )}
+            </Col>
+            <Col className="d-flex justify-content-end align-items-center">
+              <span className="me-2">Items per page:</span>
+              <Form.Select
+                size="sm"
+                style={{ width: '80px' }}
+                value={pageSize}
+                onChange={(e) => {
+                  setPageSize(Number(e.target.value))
+                  setCurrentPage(1)
+                }}
+              >
+                <option value={50}>50</option>
+                <option value={100}>100</option>
+                <option value={200}>200</option>
+                <option value={500}>500</option>
+              </Form.Select>
+            </Col>
+          </Row>
+          
           {auditData.length > 0 ? (
             <div className="table-responsive">
               <Table striped hover>
                 <thead>
-                  <tr>
-                    <th>Account Code</th>
-                    <th className="text-end">Current Year</th>
-                    <th className="text-end">Budget</th>
-                    <th className="text-end">Prior Year</th>
-                    <th>Fund</th>
-                    <th>Function</th>
-                    <th>Object</th>
-                    <th>Statement Type</th>
-                    <th>Statement Line</th>
-                    <th>Mapping Method</th>
-                    <th>Status</th>
+                  <tr style={{ cursor: 'pointer' }}>
+                    <th onClick={() => handleSort('account_code')}>Account Code{sortIndicator('account_code')}</th>
+                    <th className="text-end" onClick={() => handleSort('current_year_actual')}>Current Year{sortIndicator('current_year_actual')}</th>
+                    <th className="text-end" onClick={() => handleSort('budget')}>Budget{sortIndicator('budget')}</th>
+                    <th className="text-end" onClick={() => handleSort('prior_year_actual')}>Prior Year{sortIndicator('prior_year_actual')}</th>
+                    <th onClick={() => handleSort('fund_code')}>Fund{sortIndicator('fund_code')}</th>
+                    <th onClick={() => handleSort('function_code')}>Function{sortIndicator('function_code')}</th>
+                    <th onClick={() => handleSort('object_code')}>Object{sortIndicator('object_code')}</th>
+                    <th onClick={() => handleSort('statement_type')}>Statement Type{sortIndicator('statement_type')}</th>
+                    <th onClick={() => handleSort('statement_line_code')}>Statement Line{sortIndicator('statement_line_code')}</th>
+                    <th onClick={() => handleSort('mapping_method')}>Mapping Method{sortIndicator('mapping_method')}</th>
+                    <th onClick={() => handleSort('unmapped_accounts')}>Status{sortIndicator('unmapped_accounts')}</th>
                   </tr>
                 </thead>
                 <tbody>
-                  {auditData.slice(0, 100).map((item, index) => (
-                    <tr key={index}>
+                  {auditData.map((item, index) => (
+                    <tr key={item.row ?? index}>
                       <td>
                         <code>{item.account_code}</code>
                       </td>
@@ -354,14 +474,47 @@ export default function AuditSection() {
                 </tbody>
               </Table>
               
-              {auditData.length > 100 && (
-                <div className="text-center mt-3">
-                  <Alert variant="info">
-                    Showing first 100 records. Download the full audit trail CSV to see all {auditData.length.toLocaleString()} records.
-                  </Alert>
+              {pagination.total_pages > 1 && (
+                <div className="d-flex justify-content-center mt-3">
+                  <Pagination>
+                    <Pagination.First 
+                      onClick={() => setCurrentPage(1)}
+                      disabled={pagination.page === 1}
+                    />
+                    <Pagination.Prev 
+                      onClick={() => setCurrentPage(pagination.page - 1)}
+                      disabled={pagination.page === 1}
+                    />
+                    
+                    {generatePageNumbers().map((page, index) => (
+                      <Pagination.Item
+                        key={index}
+                        active={page === pagination.page}
+                        onClick={() => typeof page === 'number' ? setCurrentPage(page) : undefined}
+                        disabled={page === '...'}
+                      >
+                        {page}
+                      </Pagination.Item>
+                    ))}
+                    
+                    <Pagination.Next 
+                      onClick={() => setCurrentPage(pagination.page + 1)}
+                      disabled={pagination.page === pagination.total_pages}
+                    />
+                    <Pagination.Last 
+                      onClick={() => setCurrentPage(pagination.total_pages)}
+                      disabled={pagination.page === pagination.total_pages}
+                    />
+                  </Pagination>
                 </div>
               )}
             </div>
+          ) : summary && summary.total_records > 0 ? (
+            <div className="text-center py-5 text-muted">
+              <FiSearch size={48} className="mb-3" />
+              <h5>No Matching Records</h5>
+              <p>No audit trail records match the current filters.</p>
+            </div>
           ) : (
             <div className="text-center py-5 text-muted">
               <FiAlertTriangle size={48} className="mb-3" />
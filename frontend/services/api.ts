@@ -115,7 +115,44 @@ export interface AuditTrailResponse {
   }
 }
 
+export interface AuditTrailSummary {
+  total_records: number
+  mapped_records: number
+  unmapped_records: number
+  unmapped_amount: number
+}
+
+export interface AuditTrailPagination extends PaginationInfo {
+  next_cursor: string | null
+}
+
+export interface AuditTrailPageResponse {
+  success: boolean
+  audit_data: AuditTrailItem[]
+  summary: AuditTrailSummary
+  sort: string
+  order: 'asc' | 'desc'
+  pagination: AuditTrailPagination
+}
+
+export interface AuditTrailQuery {
+  page?: number
+  page_size?: number
+  cursor?: string
+  sort?: string
+  order?: 'asc' | 'desc'
+  columns?: string
+  unmapped?: boolean
+  gasb_category?: string
+  fund_code?: string
+  function_code?: string
+  statement_line_code?: string
+  rollup_applied?: boolean
+}
+
 export interface AuditTrailItem {
+  row?: number
+  
   // Original Trial Balance Data
   account_code: string
   current_year_actual: number
@@ -209,6 +246,18 @@ export const getAuditTrail = async (): Promise<AuditTrailResponse> => {
   return response.data
 }
 
+// Get one page of the stored audit trail (filtered and sorted on the server)
+export const getAuditTrailPage = async (query: AuditTrailQuery = {}): Promise<AuditTrailPageResponse> => {
+  const params = new URLSearchParams()
+  Object.entries(query).forEach(([key, value]) => {
+    if (value !== undefined && value !== '') {
+      params.append(key, String(value))
+    }
+  })
+  const response = await api.get(`/api/audit-trail/rows?${params}`)
+  return response.data
+}
+
 // Get mapping configuration
 export const getMapping = async (page: number = 1, pageSize: number = 100, search?: string): Promise<PaginatedMappingResponse> => {
   const params = new URLSearchParams({
@@ -0,0 +1,196 @@
+"""
+Background job queue persisted in SQLite
+
+Long-running work (parsing uploads, statement generation, audit trails, exports) is
+recorded in the jobs table and picked up by worker tasks running inside each app
+process. Because the queue lives in the database, queued jobs survive a restart and
+a job whose worker died is re-claimed once its heartbeat lease expires.
+"""
+
+import asyncio
+import os
+import uuid
+import aiofiles
+from fastapi import HTTPException
+from simple_auth_endpoints import (
+    create_job,
+    claim_next_job,
+    update_job_progress,
+    touch_job,
+    finish_job,
+    fail_job,
+    requeue_job,
+    list_finished_jobs,
+    delete_jobs
+)
+
+# Queue configuration (override via environment)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))  # Worker tasks per app process
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))  # Seconds between idle polls
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))  # Heartbeat age after which a running job is re-claimed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_ARTIFACT_FOLDER = os.getenv("JOB_ARTIFACT_FOLDER", "job_artifacts")
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(24 * 3600)))  # Finished jobs (and artifacts) kept this long
+JOB_CLEANUP_INTERVAL = float(os.getenv("JOB_CLEANUP_INTERVAL", "300"))  # Seconds between cleanup sweeps
+
+async def no_progress(progress: int, message: str = None):
+    """Progress callback used when work runs inline in a request"""
+
+class JobQueue:
+    """Registry of job handlers plus the worker tasks that drain the jobs table"""
+
+    def __init__(self, workers: int, poll_interval: float, lease_seconds: int, max_attempts: int, artifact_folder: str,
+                 retention_seconds: int, cleanup_interval: float):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.artifact_folder = artifact_folder
+        self.retention_seconds = retention_seconds
+        self.cleanup_interval = cleanup_interval
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._handlers = {}
+        self._tasks = []
+        self._wakeup = None
+
+    def register(self, kind: str):
+        """Decorator registering `async def handler(job, progress) -> (result, artifact)` for a job kind.
+
+        `artifact` is None or the dict returned by write_artifact().
+        """
+        def decorator(handler):
+            self._handlers[kind] = handler
+            return handler
+        return decorator
+
+    async def submit(self, user_id: str, kind: str, params: dict) -> dict:
+        """Persist a new job and wake a local worker"""
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job = await create_job(user_id, kind, params)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    async def write_artifact(self, job_id: str, filename: str, content, media_type: str) -> dict:
+        """Write a job's downloadable output (str, bytes, or an async iterator of bytes chunks) to the artifact folder"""
+        os.makedirs(self.artifact_folder, exist_ok=True)
+        # Unique per attempt, so a worker that lost the job never overwrites the artifact of the one that took it over
+        path = os.path.join(self.artifact_folder, f"{job_id}_{uuid.uuid4().hex[:8]}_{filename}")
+        if hasattr(content, '__aiter__'):
+            async with aiofiles.open(path, 'wb') as out:
+                async for chunk in content:
+                    await out.write(chunk)
+            return {'path': path, 'filename': filename, 'media_type': media_type}
+        mode = 'wb' if isinstance(content, bytes) else 'w'
+        async with aiofiles.open(path, mode) as out:
+            await out.write(content)
+        return {'path': path, 'filename': filename, 'media_type': media_type}
+
+    def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker_loop(f"{self.worker_id}-{index}")) for index in range(max(self.workers, 0))]
+        self._tasks.append(asyncio.create_task(self._cleanup_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker_loop(self, worker_id: str):
+        while True:
+            try:
+                job = await claim_next_job(worker_id, self.lease_seconds, self.max_attempts)
+            except Exception as e:
+                # e.g. database locked by another process; keep the worker alive and retry
+                print(f"Job worker {worker_id} could not claim a job: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job, worker_id)
+
+    async def _heartbeat(self, job_id: str, worker_id: str):
+        while True:
+            await asyncio.sleep(max(self.lease_seconds / 3, 1))
+            if not await touch_job(job_id, worker_id):
+                print(f"Job {job_id} was taken over by another worker; {worker_id} stops its heartbeat")
+                return
+
+    async def _run_job(self, job: dict, worker_id: str):
+        handler = self._handlers.get(job['kind'])
+        if handler is None:
+            await fail_job(job['id'], worker_id, f"Unknown job kind: {job['kind']}")
+            return
+
+        async def progress(value: int, message: str = None):
+            await update_job_progress(job['id'], worker_id, value, message)
+
+        heartbeat = asyncio.create_task(self._heartbeat(job['id'], worker_id))
+        try:
+            result, artifact = await handler(job, progress)
+        except asyncio.CancelledError:
+            # Worker shutting down: hand the job back so the next worker starts it over
+            await requeue_job(job['id'], worker_id, 'Requeued after worker shutdown')
+            raise
+        except HTTPException as e:
+            if e.status_code == 503:
+                # CPU executor saturated; retry later instead of failing the job
+                await requeue_job(job['id'], worker_id, 'Waiting for capacity')
+                await asyncio.sleep(self.poll_interval)
+            else:
+                await fail_job(job['id'], worker_id, str(e.detail))
+        except Exception as e:
+            print(f"Job {job['id']} ({job['kind']}) failed: {e}")
+            await fail_job(job['id'], worker_id, str(e))
+        else:
+            artifact = artifact or {}
+            finished = await finish_job(
+                job['id'],
+                worker_id,
+                result=result,
+                artifact_path=artifact.get('path'),
+                artifact_name=artifact.get('filename'),
+                artifact_media_type=artifact.get('media_type')
+            )
+            if not finished:
+                # Lease lost meanwhile: the worker that re-claimed the job reports its own result
+                print(f"Job {job['id']} was taken over by another worker; dropping the result of {worker_id}")
+                _remove_file(artifact.get('path'))
+        finally:
+            heartbeat.cancel()
+
+    async def cleanup(self):
+        """Delete the input files of failed jobs, and expired finished jobs together with their files"""
+        # Inputs (e.g. an upload in params['file_path']) are only needed while a job can still run
+        for job in await list_finished_jobs(status='failed'):
+            _remove_file(job['params'].get('file_path'))
+        expired = await list_finished_jobs(finished_before_seconds=self.retention_seconds)
+        for job in expired:
+            _remove_file(job['artifact_path'])
+            _remove_file(job['params'].get('file_path'))
+        await delete_jobs([job['id'] for job in expired])
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.cleanup()
+            except Exception as e:
+                print(f"Job cleanup failed: {e}")
+            await asyncio.sleep(self.cleanup_interval)
+
+def _remove_file(path: str):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+job_queue = JobQueue(
+    JOB_WORKERS, JOB_POLL_INTERVAL, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_ARTIFACT_FOLDER,
+    JOB_RETENTION_SECONDS, JOB_CLEANUP_INTERVAL
+)
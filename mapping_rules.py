@@ -8,8 +8,13 @@ This module uses pattern matching for comprehensive account code categorization:
 - Function codes (positions 3-4): Used for program expense categorization
 
 Pattern matching ensures all account codes are properly categorized, not just hardcoded ones.
+The patterns are declarative rule sets (DEFAULT_CATEGORY_RULES, plus optional per-organization
+rules) compiled into direct-index tables over every object/fund code.
 """
 
+import numpy as np
+import pandas as pd
+
 # TEA Object Code Categories (first digit determines major category)
 TEA_OBJECT_CATEGORIES = {
     '1': 'Assets',
@@ -305,116 +310,222 @@ FUND_CATEGORIES = {
 #     }
 # }
 
-def get_tea_category(account_code):
-    """Get TEA category based on account code"""
-    if len(account_code) >= 9:  # Need at least 9 digits for object code
-        first_digit = account_code[5]  # Object code starts at position 5 (0-indexed)
-        return TEA_OBJECT_CATEGORIES.get(first_digit, 'Unknown')
-    return 'Unknown'
+# TEA account code layout: fund 0-3, function 3-5, object 5-9, sub-object 9-13, location 13-19
+ACCOUNT_CODE_COMPONENTS = [
+    ('fund_code', 0, 3),
+    ('function_code', 3, 5),
+    ('object_code', 5, 9),
+    ('sub_object_code', 9, 13),
+    ('location_code', 13, 19),
+]
 
-def get_gasb_category(account_code):
-    """Get GASB category based on account code using pattern matching"""
-    if len(account_code) >= 9:  # Need at least 9 digits for object code
-        object_code = account_code[5:9]  # Extract 4-digit object code (positions 5-8)
-        
-        # First try exact matches in the predefined categories
-        for category, details in GASB_CATEGORIES.items():
-            if object_code in details['tea_codes']:
-                return category
-        
-        # Pattern matching fallback for comprehensive coverage
-        if object_code.startswith('1'):  # All assets (1000-1999)
-            if object_code.startswith(('11', '12', '13', '14')):  # Current assets (1100-1499)
-                return 'current_assets'
-            elif object_code.startswith('15'):  # Capital assets (1500-1599)
-                return 'capital_assets'
-            elif object_code.startswith('17'):  # Deferred outflows (1700-1799)
-                return 'deferred_outflows'
-            else:
-                return 'current_assets'  # Default to current assets for other 1XXX codes
-                
-        elif object_code.startswith('2'):  # All liabilities (2000-2999)
-            if object_code.startswith(('21', '22', '23')):  # Current liabilities (2100-2399)
-                return 'current_liabilities'
-            elif object_code.startswith(('24', '25')):  # Long-term liabilities (2400-2599)
-                return 'long_term_liabilities'
-            elif object_code.startswith('26'):  # Deferred inflows (2600-2699)
-                return 'deferred_inflows'
-            else:
-                return 'current_liabilities'  # Default to current liabilities for other 2XXX codes
-                
-        elif object_code.startswith('3'):  # All net position (3000-3999)
-            if object_code.startswith('32'):  # Net investment in capital assets (3200-3299)
-                return 'net_investment_capital_assets'
-            elif object_code.startswith(('33', '34', '35', '36', '37', '38')):  # Restricted net position (3300-3899)
-                return 'restricted_net_position'
-            elif object_code.startswith('39'):  # Unrestricted net position (3900-3999)
-                return 'unrestricted_net_position'
-            else:
-                return 'restricted_net_position'  # Default to restricted for other 3XXX codes
-                
-        elif object_code.startswith('5'):  # All revenues (5000-5999)
-            if object_code.startswith(('51', '52', '53')):  # Program revenues (5100-5399)
-                return 'program_revenues'
-            else:  # General revenues (5400-5999)
-                return 'general_revenues'
-                
-        elif object_code.startswith('6'):  # All expenses (6000-6999)
-            if object_code.startswith(('61', '62', '63', '64', '65')):  # Program expenses (6100-6599)
-                return 'program_expenses'
-            else:  # General expenses (6600-6999)
-                return 'general_expenses'
-                
-        elif object_code.startswith('7'):  # Other resources/non-operating revenues (7000-7999)
-            return 'other_resources'
-            
-        elif object_code.startswith('8'):  # Other uses/non-operating expenses (8000-8999)
-            return 'other_uses'
+# Declarative category rules. Each rule maps a prefix (or list of prefixes) or an inclusive range of
+# one code component to a category, e.g. {'prefix': '15', 'category': 'capital_assets', 'priority': 20}
+# or {'range': ['1100', '1499'], 'category': 'current_assets', 'priority': 20}. Of the rules matching
+# a code the highest priority wins, then the one listed first; codes matched by no rule, or too
+# short to hold the component, get the field's default. Ranges only match all-digit components.
+# Custom rules without a priority get CUSTOM_RULE_PRIORITY, above every default rule.
+CATEGORY_FIELDS = {
+    # field: (code component the rules read, default category)
+    'tea_category': ('object_code', 'Unknown'),
+    'gasb_category': ('object_code', 'unknown'),
+    'fund_category': ('fund_code', 'other_governmental_funds'),
+}
+
+DEFAULT_CATEGORY_RULES = {
+    'tea_category': [
+        # First digit of the object code
+        {'prefix': digit, 'category': category, 'priority': 10}
+        for digit, category in TEA_OBJECT_CATEGORIES.items()
+    ],
+    'gasb_category': [
+        # Object codes listed in GASB_CATEGORIES
+        *({'prefix': details['tea_codes'], 'category': category, 'priority': 100} for category, details in GASB_CATEGORIES.items()),
+        # All assets (1000-1999); other 1XXX default to current assets
+        {'prefix': ['11', '12', '13', '14'], 'category': 'current_assets', 'priority': 20},
+        {'prefix': '15', 'category': 'capital_assets', 'priority': 20},
+        {'prefix': '17', 'category': 'deferred_outflows', 'priority': 20},
+        {'prefix': '1', 'category': 'current_assets', 'priority': 10},
+        # All liabilities (2000-2999); other 2XXX default to current liabilities
+        {'prefix': ['21', '22', '23'], 'category': 'current_liabilities', 'priority': 20},
+        {'prefix': ['24', '25'], 'category': 'long_term_liabilities', 'priority': 20},
+        {'prefix': '26', 'category': 'deferred_inflows', 'priority': 20},
+        {'prefix': '2', 'category': 'current_liabilities', 'priority': 10},
+        # All net position (3000-3999); other 3XXX default to restricted
+        {'prefix': '32', 'category': 'net_investment_capital_assets', 'priority': 20},
+        {'prefix': ['33', '34', '35', '36', '37', '38'], 'category': 'restricted_net_position', 'priority': 20},
+        {'prefix': '39', 'category': 'unrestricted_net_position', 'priority': 20},
+        {'prefix': '3', 'category': 'restricted_net_position', 'priority': 10},
+        # Program revenues (5100-5399), general revenues (5400-5999)
+        {'prefix': ['51', '52', '53'], 'category': 'program_revenues', 'priority': 20},
+        {'prefix': '5', 'category': 'general_revenues', 'priority': 10},
+        # Program expenses (6100-6599), general expenses (6600-6999)
+        {'prefix': ['61', '62', '63', '64', '65'], 'category': 'program_expenses', 'priority': 20},
+        {'prefix': '6', 'category': 'general_expenses', 'priority': 10},
+        # Other resources / uses (7000-8999)
+        {'prefix': '7', 'category': 'other_resources', 'priority': 10},
+        {'prefix': '8', 'category': 'other_uses', 'priority': 10},
+    ],
+    'fund_category': [
+        # Fund codes listed in FUND_CATEGORIES
+        *({'prefix': details['fund_codes'], 'category': category, 'priority': 100} for category, details in FUND_CATEGORIES.items()),
+        {'prefix': '1', 'category': 'general_fund', 'priority': 10},
+        {'prefix': '2', 'category': 'special_revenue_funds', 'priority': 10},
+        {'prefix': '5', 'category': 'debt_service_funds', 'priority': 10},
+        {'prefix': '6', 'category': 'capital_projects_funds', 'priority': 10},
+        {'prefix': '7', 'category': 'permanent_funds', 'priority': 10},
+    ],
+}
+
+CUSTOM_RULE_PRIORITY = max(rule['priority'] for rules in DEFAULT_CATEGORY_RULES.values() for rule in rules) + 1
+
+def _parse_category_rule(rule, width, default_priority=0):
+    """(prefixes, (low, high) or None, category, priority) of a declarative rule; ValueError if malformed"""
+    if not isinstance(rule, dict):
+        raise ValueError(f"Rule must be an object: {rule!r}")
+    category, priority = rule.get('category'), rule.get('priority', default_priority)
+    if not isinstance(category, str) or not category:
+        raise ValueError(f"Rule needs a category: {rule!r}")
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        raise ValueError(f"Rule priority must be an integer: {rule!r}")
+    
+    def is_code(value, lengths):
+        return isinstance(value, str) and len(value) in lengths and value.isascii() and value.isdigit()
     
-    return 'unknown'
+    if ('prefix' in rule) == ('range' in rule):
+        raise ValueError(f"Rule needs exactly one of prefix or range: {rule!r}")
+    if 'prefix' in rule:
+        prefixes = [rule['prefix']] if isinstance(rule['prefix'], str) else rule['prefix']
+        if not isinstance(prefixes, list) or not prefixes or not all(is_code(p, range(1, width + 1)) for p in prefixes):
+            raise ValueError(f"Rule prefixes must be 1 to {width} digits: {rule!r}")
+        return tuple(prefixes), None, category, priority
+    bounds = rule['range']
+    if not isinstance(bounds, list) or len(bounds) != 2 or not all(is_code(b, (width,)) for b in bounds) or bounds[0] > bounds[1]:
+        raise ValueError(f"Rule range must be [low, high] codes of {width} digits: {rule!r}")
+    return (), (int(bounds[0]), int(bounds[1])), category, priority
 
-def get_fund_category(account_code):
-    """Get fund category based on account code using pattern matching"""
-    if len(account_code) >= 3:
-        fund_code = account_code[0:3]  # First 3 digits are fund code
-        
-        # First try exact matches in the predefined categories
-        for category, details in FUND_CATEGORIES.items():
-            if fund_code in details['fund_codes']:
-                return category
-        
-        # Pattern matching fallback for comprehensive coverage
-        if fund_code.startswith('1'):  # General Fund (100-199)
-            return 'general_fund'
-        elif fund_code.startswith('2'):  # Special Revenue Funds (200-299)
-            return 'special_revenue_funds'
-        elif fund_code.startswith('5'):  # Debt Service Funds (500-599)
-            return 'debt_service_funds'
-        elif fund_code.startswith('6'):  # Capital Projects Funds (600-699)
-            return 'capital_projects_funds'
-        elif fund_code.startswith('7'):  # Permanent Funds (700-799)
-            return 'permanent_funds'
-        else:
-            return 'other_governmental_funds'  # Default for other fund codes
+def compile_category_rules(rule_set=None):
+    """Compile {field: [rules]} (evaluated ahead of DEFAULT_CATEGORY_RULES) into a direct-index table per field.
+
+    A component of width w gets a table of 10**w categories: each prefix or range is an interval of
+    it, painted from the lowest priority up, so categorizing a code is one array lookup.
+    """
+    rule_set = rule_set or {}
+    if not isinstance(rule_set, dict):
+        raise ValueError("Rule set must map category fields to lists of rules")
+    unknown = set(rule_set) - set(CATEGORY_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown category field: {', '.join(sorted(unknown))}. Valid values: {', '.join(CATEGORY_FIELDS)}")
+    spans = {name: (start, stop) for name, start, stop in ACCOUNT_CODE_COMPONENTS}
     
-    return 'other_governmental_funds'
+    compiled = {}
+    for field, (component, default) in CATEGORY_FIELDS.items():
+        start, stop = spans[component]
+        width = stop - start
+        if not isinstance(rule_set.get(field, []), list):
+            raise ValueError(f"Rules for {field} must be a list")
+        rules = [_parse_category_rule(rule, width, CUSTOM_RULE_PRIORITY) for rule in rule_set.get(field, [])]
+        rules += [_parse_category_rule(rule, width) for rule in DEFAULT_CATEGORY_RULES[field]]
+        
+        table = np.full(10 ** width, default, dtype=object)
+        # Stable sort of the reversed list: within a priority the first listed rule is painted last
+        for prefixes, bounds, category, _ in sorted(reversed(rules), key=lambda rule: rule[3]):
+            for prefix in prefixes:
+                span = 10 ** (width - len(prefix))
+                table[int(prefix) * span:(int(prefix) + 1) * span] = category
+            if bounds:
+                table[bounds[0]:bounds[1] + 1] = category
+        compiled[field] = {'start': start, 'stop': stop, 'default': default, 'rules': rules, 'table': table}
+    return compiled
+
+def _match_category_rules(compiled, component):
+    """Category of a component with non-digit characters (rare): best matching prefix rule, else the default"""
+    best, best_priority = compiled['default'], None
+    for prefixes, _, category, priority in compiled['rules']:
+        if (best_priority is None or priority > best_priority) and component.startswith(prefixes):
+            best, best_priority = category, priority
+    return best
+
+DEFAULT_COMPILED_CATEGORY_RULES = compile_category_rules()
+
+def get_category(account_code, field, rules=None):
+    """Category of one account code for a CATEGORY_FIELDS field (rules from compile_category_rules())"""
+    compiled = (rules or DEFAULT_COMPILED_CATEGORY_RULES)[field]
+    if len(account_code) < compiled['stop']:
+        return compiled['default']
+    component = account_code[compiled['start']:compiled['stop']]
+    if component.isascii() and component.isdigit():
+        return compiled['table'][int(component)]
+    return _match_category_rules(compiled, component)
 
-def create_default_mapping(account_codes):
-    """Create default mapping for a list of account codes"""
-    mapping = {}
+def get_tea_category(account_code, rules=None):
+    """Get TEA category based on account code (first digit of the object code)"""
+    return get_category(account_code, 'tea_category', rules)
+
+def get_gasb_category(account_code, rules=None):
+    """Get GASB category based on account code (object code, positions 5-8)"""
+    return get_category(account_code, 'gasb_category', rules)
+
+def get_fund_category(account_code, rules=None):
+    """Get fund category based on account code (fund code, positions 0-2)"""
+    return get_category(account_code, 'fund_category', rules)
+
+def _code_points(account_codes):
+    """Account codes as a (rows, longest code) array of Unicode code points, zero-padded, plus their lengths"""
+    codes = pd.Series(account_codes, dtype=object).astype(str).to_numpy(dtype=str)
+    points = codes.view(np.uint32).reshape(len(codes), max(codes.dtype.itemsize // 4, 1))
+    return codes, points, np.char.str_len(codes)
+
+def resolve_categories(account_codes, field, rules=None):
+    """get_category() for a whole sequence/Series of account codes, as an array"""
+    compiled = (rules or DEFAULT_COMPILED_CATEGORY_RULES)[field]
+    start, stop = compiled['start'], compiled['stop']
+    codes, points, lengths = _code_points(account_codes)
+    long_enough = lengths >= stop
+    result = np.full(len(codes), compiled['default'], dtype=object)
+    numeric = np.zeros(len(codes), dtype=bool)
+    if points.shape[1] >= stop:
+        digits = points[:, start:stop].astype(np.int64) - ord('0')
+        numeric = long_enough & ((digits >= 0) & (digits <= 9)).all(axis=1)
+        result[numeric] = np.take(compiled['table'], digits[numeric] @ 10 ** np.arange(stop - start - 1, -1, -1))
+    # Components with other characters (rare) are matched against the prefix rules one by one
+    for i in np.flatnonzero(long_enough & ~numeric):
+        result[i] = _match_category_rules(compiled, codes[i][start:stop])
+    return result
+
+def resolve_tea_categories(account_codes, rules=None):
+    """get_tea_category() for a whole sequence/Series of account codes, as an array"""
+    return resolve_categories(account_codes, 'tea_category', rules)
+
+def resolve_gasb_categories(account_codes, rules=None):
+    """get_gasb_category() for a whole sequence/Series of account codes, as an array"""
+    return resolve_categories(account_codes, 'gasb_category', rules)
+
+def resolve_fund_categories(account_codes, rules=None):
+    """get_fund_category() for a whole sequence/Series of account codes, as an array"""
+    return resolve_categories(account_codes, 'fund_category', rules)
+
+def create_default_mapping(account_codes, rules=None):
+    """Create default mapping for a list of account codes (rules: an organization's compiled category rules)"""
+    account_codes = list(account_codes)
+    
+    # Categorize column-wise; only building the per-account dicts is left to Python
+    tea_categories = resolve_tea_categories(account_codes, rules)
+    gasb_categories = resolve_gasb_categories(account_codes, rules)
+    fund_categories = resolve_fund_categories(account_codes, rules)
     
-    for code in account_codes:
-        mapping[code] = {
+    return {
+        code: {
             'account_code': code,
             'description': f'Account {code}',
-            'tea_category': get_tea_category(code),
-            'gasb_category': get_gasb_category(code),
-            'fund_category': get_fund_category(code),
+            'tea_category': tea_category,
+            'gasb_category': gasb_category,
+            'fund_category': fund_category,
             'statement_line': 'XX',  # To be determined during statement generation
             'notes': ''
         }
-    
-    return mapping
+        for code, tea_category, gasb_category, fund_category in zip(account_codes, tea_categories, gasb_categories, fund_categories)
+    }
 
 def validate_account_code(account_code):
     """Validate TEA account code format and extract components"""
@@ -453,23 +564,36 @@ def get_account_components(account_code):
             'error': result
         }
 
+def mapping_status(account_code, gasb_category):
+    """How validate_mapping() counts one mapping: 'invalid' (bad account code), 'unmapped' or 'mapped'"""
+    is_valid, _ = validate_account_code(account_code)
+    if not is_valid:
+        return 'invalid'
+    if gasb_category and gasb_category != 'unknown':
+        return 'mapped'
+    return 'unmapped'
+
 def validate_mapping(mapping):
     """Validate that mapping covers the accounts that need mapping"""
-    mapped_categories = set()
+    category_counts = {}
     unmapped_accounts = []
     invalid_accounts = []
     
     for account_code, account_mapping in mapping.items():
-        # Validate account code format
-        is_valid, _ = validate_account_code(account_code)
-        if not is_valid:
+        gasb_category = account_mapping.get('gasb_category')
+        status = mapping_status(account_code, gasb_category)
+        if status == 'invalid':
             invalid_accounts.append(account_code)
-            continue
-            
-        if account_mapping.get('gasb_category') and account_mapping.get('gasb_category') != 'unknown':
-            mapped_categories.add(account_mapping['gasb_category'])
-        else:
+        elif status == 'unmapped':
             unmapped_accounts.append(account_code)
+        else:
+            category_counts[gasb_category] = category_counts.get(gasb_category, 0) + 1
+    
+    return validation_summary(category_counts, len(unmapped_accounts), len(invalid_accounts), unmapped_accounts[:10], invalid_accounts[:10])
+
+def validation_summary(category_counts, total_unmapped, total_invalid, unmapped_accounts, invalid_accounts):
+    """validate_mapping() result from running totals (category_counts: mapped accounts per GASB category)"""
+    mapped_categories = {category for category, count in category_counts.items() if count}
     
     # Check if we have a good distribution of categories for financial statements
     essential_categories = {
@@ -486,11 +610,11 @@ def validate_mapping(mapping):
             warnings.append(f"No {category_group.replace('_', ' ')} categories mapped")
     
     return {
-        'valid': len(unmapped_accounts) == 0 and len(invalid_accounts) == 0,
+        'valid': total_unmapped == 0 and total_invalid == 0,
         'unmapped_accounts': unmapped_accounts[:10],  # Show first 10 unmapped accounts
         'invalid_accounts': invalid_accounts[:10],  # Show first 10 invalid accounts
-        'total_unmapped': len(unmapped_accounts),
-        'total_invalid': len(invalid_accounts),
+        'total_unmapped': total_unmapped,
+        'total_invalid': total_invalid,
         'mapped_categories': list(mapped_categories),
         'warnings': warnings,
         'has_essential_categories': len(warnings) == 0
@@ -2,7 +2,13 @@
 Simple authentication endpoints to replace FastAPI Users
 """
 
+import asyncio
+import hashlib
+import io
 import json
+import os
+import queue
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
 from typing import Optional
 from fastapi import APIRouter, HTTPException, Depends, status, Form
@@ -10,8 +16,12 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+import aiosqlite
+import numpy as np
+import pandas as pd
 import sqlite3
 import uuid
+from mapping_rules import mapping_status, validation_summary
 
 # JWT Configuration
 SECRET_KEY = "your-secret-key-change-in-production"
@@ -27,6 +37,120 @@ security = HTTPBearer()
 # Database setup
 DATABASE_URL = "tea_financial.db"
 
+# Connection pool configuration (override via environment)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))  # Idle connections kept open for reuse
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-20000")),  # Negative = KiB, i.e. ~20MB
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+}
+
+class SQLiteConnectionPool:
+    """Thread-safe pool of long-lived SQLite connections with tuned pragmas"""
+    
+    def __init__(self, database: str, pool_size: int, pragmas: dict):
+        self.database = database
+        self.pragmas = pragmas
+        self._idle = queue.LifoQueue(maxsize=max(pool_size, 1))
+    
+    def _connect(self) -> sqlite3.Connection:
+        # Connections move between worker threads, but are only used by one at a time
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+    
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            # Pool exhausted: open an extra connection; release() closes it if the pool is full
+            return self._connect()
+    
+    def release(self, conn: sqlite3.Connection):
+        # Never hand a half-finished transaction to the next caller
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+db_pool = SQLiteConnectionPool(DATABASE_URL, DB_POOL_SIZE, SQLITE_PRAGMAS)
+
+@contextmanager
+def db_connection():
+    """Borrow a pooled connection; it is returned (rolled back if uncommitted) on exit"""
+    conn = db_pool.acquire()
+    try:
+        yield conn
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        db_pool.release(conn)
+
+class AsyncSQLiteConnectionPool:
+    """Pool of aiosqlite connections used by the request-path persistence helpers"""
+    
+    def __init__(self, database: str, pool_size: int, pragmas: dict):
+        self.database = database
+        self.pragmas = pragmas
+        self._idle = asyncio.LifoQueue(maxsize=max(pool_size, 1))
+    
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.database)
+        for name, value in self.pragmas.items():
+            await conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+    
+    async def acquire(self) -> aiosqlite.Connection:
+        try:
+            return self._idle.get_nowait()
+        except asyncio.QueueEmpty:
+            return await self._connect()
+    
+    async def release(self, conn: aiosqlite.Connection):
+        if conn.in_transaction:
+            await conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except asyncio.QueueFull:
+            await conn.close()
+    
+    async def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            await conn.close()
+
+async_db_pool = AsyncSQLiteConnectionPool(DATABASE_URL, DB_POOL_SIZE, SQLITE_PRAGMAS)
+
+@asynccontextmanager
+async def async_db_connection():
+    """Async counterpart of db_connection(): queries run on aiosqlite's worker thread"""
+    conn = await async_db_pool.acquire()
+    try:
+        yield conn
+    except Exception:
+        if conn.in_transaction:
+            await conn.rollback()
+        raise
+    finally:
+        await async_db_pool.release(conn)
+
 # Pydantic models
 class UserCreate(BaseModel):
     email: str
@@ -55,237 +179,670 @@ class Token(BaseModel):
 # Database functions
 def init_db():
     """Initialize the database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    # Create users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id TEXT PRIMARY KEY,
-            email TEXT UNIQUE NOT NULL,
-            hashed_password TEXT NOT NULL,
-            first_name TEXT,
-            last_name TEXT,
-            organization TEXT,
-            is_active BOOLEAN DEFAULT 1,
-            is_verified BOOLEAN DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create trial_balance_data table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS trial_balance_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            encoding TEXT,
-            delimiter TEXT,
-            rows INTEGER,
-            columns INTEGER,
-            data_json TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Create account_mappings table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS account_mappings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            account_code TEXT NOT NULL,
-            description TEXT,
-            tea_category TEXT,
-            gasb_category TEXT,
-            fund_category TEXT,
-            statement_line TEXT,
-            notes TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id),
-            UNIQUE(user_id, account_code)
-        )
-    ''')
-    
-    # Create financial_statements table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS financial_statements (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            statement_type TEXT NOT NULL,
-            statement_data TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS audit_trails (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            audit_data TEXT NOT NULL,
-            total_records INTEGER NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Create users table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                email TEXT UNIQUE NOT NULL,
+                hashed_password TEXT NOT NULL,
+                first_name TEXT,
+                last_name TEXT,
+                organization TEXT,
+                is_active BOOLEAN DEFAULT 1,
+                is_verified BOOLEAN DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Create trial_balance_data table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS trial_balance_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                encoding TEXT,
+                delimiter TEXT,
+                rows INTEGER,
+                columns INTEGER,
+                data_json TEXT NOT NULL DEFAULT '',
+                data_blob BLOB,
+                content_hash TEXT,
+                cube_blob BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        
+        # Databases created before columnar storage only have data_json
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(trial_balance_data)")}
+        if 'data_blob' not in existing_columns:
+            cursor.execute("ALTER TABLE trial_balance_data ADD COLUMN data_blob BLOB")
+        if 'content_hash' not in existing_columns:
+            cursor.execute("ALTER TABLE trial_balance_data ADD COLUMN content_hash TEXT")
+        if 'cube_blob' not in existing_columns:
+            cursor.execute("ALTER TABLE trial_balance_data ADD COLUMN cube_blob BLOB")
+        
+        # Create account_mappings table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS account_mappings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                account_code TEXT NOT NULL,
+                description TEXT,
+                tea_category TEXT,
+                gasb_category TEXT,
+                fund_category TEXT,
+                statement_line TEXT,
+                notes TEXT,
+                validation_status TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                UNIQUE(user_id, account_code)
+            )
+        ''')
+        
+        # Databases created before incremental validation: classify the existing mappings once
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(account_mappings)")}
+        if 'validation_status' not in existing_columns:
+            cursor.execute("ALTER TABLE account_mappings ADD COLUMN validation_status TEXT")
+            rows = cursor.execute("SELECT id, account_code, gasb_category FROM account_mappings").fetchall()
+            cursor.executemany(
+                "UPDATE account_mappings SET validation_status = ? WHERE id = ?",
+                [(mapping_status(account_code, gasb_category), row_id) for row_id, account_code, gasb_category in rows]
+            )
+        # Serves the first unmapped/invalid accounts of a user without scanning the mapping set
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_account_mappings_status ON account_mappings (user_id, validation_status, account_code)")
+        
+        # Create financial_statements table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS financial_statements (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                statement_type TEXT NOT NULL,
+                statement_data TEXT NOT NULL,
+                cache_key TEXT,
+                line_assignment BLOB,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        
+        # Databases created before the statement cache have no cache_key
+        existing_columns = {row[1] for row in cursor.execute("PRAGMA table_info(financial_statements)")}
+        if 'cache_key' not in existing_columns:
+            cursor.execute("ALTER TABLE financial_statements ADD COLUMN cache_key TEXT")
+        if 'line_assignment' not in existing_columns:
+            cursor.execute("ALTER TABLE financial_statements ADD COLUMN line_assignment BLOB")
+        
+        # Create mapping_versions table (content hash and validation counters of each user's mapping set, updated on every save)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS mapping_versions (
+                user_id TEXT PRIMARY KEY,
+                mapping_hash TEXT NOT NULL,
+                mapping_count INTEGER NOT NULL,
+                validation_json TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        
+        # Create mapping_rule_sets table (declarative category rules, as JSON, keyed by 'user:<id>')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS mapping_rule_sets (
+                owner TEXT PRIMARY KEY,
+                rules_json TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Create audit_runs table (one row per audit trail build: the fields shared by all its records, plus summary counts)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS audit_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                version TEXT,
+                file_upload_date TEXT,
+                processing_timestamp TEXT,
+                total_records INTEGER NOT NULL DEFAULT 0,
+                unmapped_records INTEGER NOT NULL DEFAULT 0,
+                unmapped_amount REAL NOT NULL DEFAULT 0,
+                cache_key TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_audit_runs_user ON audit_runs (user_id, id)")
+        
+        # Create audit_trail_rows table (one row per trial balance row of a run, for paged reads)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS audit_trail_rows (
+                run_id INTEGER NOT NULL,
+                row_index INTEGER NOT NULL,
+                account_code TEXT,
+                current_year_actual REAL,
+                budget REAL,
+                prior_year_actual REAL,
+                fund_code TEXT,
+                function_code TEXT,
+                object_code TEXT,
+                sub_object_code TEXT,
+                location_code TEXT,
+                unmapped_accounts INTEGER,
+                tea_category TEXT,
+                gasb_category TEXT,
+                fund_category TEXT,
+                statement_type TEXT,
+                statement_section TEXT,
+                statement_line_code TEXT,
+                statement_line_description TEXT,
+                mapping_method TEXT,
+                mapping_confidence TEXT,
+                processing_notes TEXT,
+                rollup_applied INTEGER,
+                rollup_description TEXT,
+                PRIMARY KEY (run_id, row_index),
+                FOREIGN KEY (run_id) REFERENCES audit_runs (id)
+            )
+        ''')
+        # Each filter column gets an index that also yields its rows in trial balance order
+        for column in AUDIT_TRAIL_FILTER_COLUMNS:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_audit_trail_rows_{column} ON audit_trail_rows (run_id, {column}, row_index)")
+        _migrate_legacy_audit_trails(cursor)
+        
+        # Create jobs table (background work queue, shared by all app workers)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                progress INTEGER NOT NULL DEFAULT 0,
+                message TEXT,
+                params TEXT NOT NULL DEFAULT '{}',
+                result TEXT,
+                error TEXT,
+                artifact_path TEXT,
+                artifact_name TEXT,
+                artifact_media_type TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                heartbeat_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user_created ON jobs (user_id, created_at)")
+        
+        conn.commit()
 
 # Database functions for mappings and data
-def save_trial_balance_data(user_id: str, filename: str, encoding: str, delimiter: str, rows: int, columns: int, data_json: str):
-    """Save trial balance data to database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    # Delete existing data for this user
-    cursor.execute("DELETE FROM trial_balance_data WHERE user_id = ?", (user_id,))
-    
-    # Insert new data
-    cursor.execute('''
-        INSERT INTO trial_balance_data (user_id, filename, encoding, delimiter, rows, columns, data_json)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, filename, encoding, delimiter, rows, columns, data_json))
+def trial_balance_arrays(df: pd.DataFrame) -> dict:
+    """Typed NumPy array per trial balance column (codes as strings, amounts as float64)"""
+    arrays = {}
+    for col in df.columns:
+        if col == 'account_code':
+            arrays[col] = df[col].astype(str).to_numpy(dtype=str)
+        else:
+            arrays[col] = pd.to_numeric(df[col], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    return arrays
+
+def trial_balance_digest(arrays: dict) -> str:
+    """Content hash of a trial balance, independent of how it was serialized"""
+    # Hash the arrays rather than the .npz blob: zip entries carry write timestamps
+    digest = hashlib.sha256()
+    for col, values in arrays.items():
+        digest.update(f"{col}:{values.dtype.str}:{len(values)};".encode())
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+def trial_balance_to_blob(df: pd.DataFrame) -> bytes:
+    """Serialize a parsed trial balance to typed NumPy arrays (one per column) in an .npz blob"""
+    buffer = io.BytesIO()
+    np.savez(buffer, **trial_balance_arrays(df))
+    return buffer.getvalue()
+
+def trial_balance_blob_and_digest(df: pd.DataFrame) -> tuple:
+    """trial_balance_to_blob() plus trial_balance_digest(), converting the columns once"""
+    arrays = trial_balance_arrays(df)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue(), trial_balance_digest(arrays)
+
+def trial_balance_from_blob(blob: bytes) -> pd.DataFrame:
+    """Load a trial balance stored by trial_balance_to_blob (no JSON decoding, codes stay strings)"""
+    with np.load(io.BytesIO(blob), allow_pickle=False) as arrays:
+        return pd.DataFrame({col: arrays[col] for col in arrays.files})
+
+async def save_trial_balance_data(user_id: str, filename: str, encoding: str, delimiter: str, rows: int, columns: int, df: pd.DataFrame, cube_blob: bytes = None):
+    """Save trial balance data (and its aggregate cube, if built) to database"""
+    data_blob, content_hash = await asyncio.to_thread(trial_balance_blob_and_digest, df)
     
-    conn.commit()
-    conn.close()
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        # Delete existing data for this user
+        await cursor.execute("DELETE FROM trial_balance_data WHERE user_id = ?", (user_id,))
+        
+        # Insert new data
+        await cursor.execute('''
+            INSERT INTO trial_balance_data (user_id, filename, encoding, delimiter, rows, columns, data_json, data_blob, content_hash, cube_blob)
+            VALUES (?, ?, ?, ?, ?, ?, '', ?, ?, ?)
+        ''', (user_id, filename, encoding, delimiter, rows, columns, sqlite3.Binary(data_blob), content_hash, cube_blob))
+        
+        await conn.commit()
 
-def get_trial_balance_data(user_id: str):
+async def get_trial_balance_data(user_id: str):
     """Get trial balance data from database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT filename, encoding, delimiter, rows, columns, data_json, created_at
-        FROM trial_balance_data 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC 
-        LIMIT 1
-    ''', (user_id,))
-    
-    result = cursor.fetchone()
-    conn.close()
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await cursor.execute('''
+            SELECT filename, encoding, delimiter, rows, columns, data_json, data_blob, created_at, content_hash
+            FROM trial_balance_data
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', (user_id,))
+        
+        result = await cursor.fetchone()
     
     if result:
+        if result[6] is not None:
+            data_frame = await asyncio.to_thread(trial_balance_from_blob, result[6])
+        else:
+            # Rows saved before columnar storage still carry the JSON payload
+            data_frame = await asyncio.to_thread(pd.read_json, io.StringIO(result[5]), dtype={'account_code': str})
+        content_hash = result[8]
+        if content_hash is None:
+            content_hash = await asyncio.to_thread(lambda: trial_balance_digest(trial_balance_arrays(data_frame)))
         return {
             'filename': result[0],
             'encoding': result[1],
             'delimiter': result[2],
             'rows': result[3],
             'columns': result[4],
-            'data_json': result[5],
-            'created_at': result[6]
+            'data_frame': data_frame,
+            'content_hash': content_hash,
+            'created_at': result[7]
         }
     return None
 
-def save_account_mappings(user_id: str, mappings: dict):
-    """Save account mappings to database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
+async def get_trial_balance_metadata(user_id: str):
+    """File info, upload time and content hash of the user's stored trial balance without loading the data (None if no upload)"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await cursor.execute('''
+            SELECT id, content_hash, filename, encoding, delimiter, rows, columns, created_at
+            FROM trial_balance_data
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', (user_id,))
+        
+        result = await cursor.fetchone()
     
-    # If empty mappings dict, delete all mappings for this user
-    if not mappings:
-        cursor.execute("DELETE FROM account_mappings WHERE user_id = ?", (user_id,))
-    else:
-        for account_code, mapping_data in mappings.items():
-            if mapping_data is None:
-                # Delete mapping
-                cursor.execute("DELETE FROM account_mappings WHERE user_id = ? AND account_code = ?", (user_id, account_code))
-            else:
-                # Insert or update mapping
-                cursor.execute('''
-                    INSERT OR REPLACE INTO account_mappings 
-                    (user_id, account_code, description, tea_category, gasb_category, fund_category, statement_line, notes, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-                ''', (
-                    user_id, 
-                    account_code,
-                    mapping_data.get('description', ''),
-                    mapping_data.get('tea_category', ''),
-                    mapping_data.get('gasb_category', ''),
-                    mapping_data.get('fund_category', ''),
-                    mapping_data.get('statement_line', 'XX'),
-                    mapping_data.get('notes', '')
-                ))
-    
-    conn.commit()
-    conn.close()
-
-def get_account_mappings(user_id: str, page: int = 1, page_size: int = 100, search: str = None):
+    if result is None:
+        return None
+    metadata = dict(zip(('filename', 'encoding', 'delimiter', 'rows', 'columns', 'created_at'), result[2:]))
+    metadata['content_hash'] = result[1]
+    if result[1] is not None:
+        return metadata
+    
+    # Uploaded before content hashes were recorded: hash once and backfill the row
+    tb_data = await get_trial_balance_data(user_id)
+    async with async_db_connection() as conn:
+        await conn.execute("UPDATE trial_balance_data SET content_hash = ? WHERE id = ?", (tb_data['content_hash'], result[0]))
+        await conn.commit()
+    metadata['content_hash'] = tb_data['content_hash']
+    return metadata
+
+async def get_trial_balance_hash(user_id: str):
+    """Content hash of the user's stored trial balance without loading the data (None if no upload)"""
+    metadata = await get_trial_balance_metadata(user_id)
+    return metadata['content_hash'] if metadata else None
+
+async def get_trial_balance_cube(user_id: str):
+    """Stored aggregate cube of the user's trial balance without loading the data (None if no upload)"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await cursor.execute('''
+            SELECT id, cube_blob
+            FROM trial_balance_data
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', (user_id,))
+        
+        result = await cursor.fetchone()
+    
+    if result is None:
+        return None
+    return {'id': result[0], 'cube_blob': result[1]}
+
+async def save_trial_balance_cube(trial_balance_id: int, cube_blob: bytes):
+    """Attach a (re)built aggregate cube to a stored trial balance"""
+    async with async_db_connection() as conn:
+        await conn.execute("UPDATE trial_balance_data SET cube_blob = ? WHERE id = ?", (sqlite3.Binary(cube_blob), trial_balance_id))
+        await conn.commit()
+
+async def get_mapping_rule_set(owner: str):
+    """Stored category rules of an owner ({'rules', 'rules_json', 'updated_at'}), or None for the defaults"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        await cursor.execute("SELECT rules_json, updated_at FROM mapping_rule_sets WHERE owner = ?", (owner,))
+        result = await cursor.fetchone()
+    
+    if result is None:
+        return None
+    return {'rules': json.loads(result[0]), 'rules_json': result[0], 'updated_at': result[1]}
+
+async def save_mapping_rule_set(owner: str, rules: Optional[dict]):
+    """Replace an owner's category rules; empty or None reverts to the defaults"""
+    async with async_db_connection() as conn:
+        if rules:
+            await conn.execute('''
+                INSERT OR REPLACE INTO mapping_rule_sets (owner, rules_json, updated_at)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+            ''', (owner, json.dumps(rules, sort_keys=True)))
+        else:
+            await conn.execute("DELETE FROM mapping_rule_sets WHERE owner = ?", (owner,))
+        await conn.commit()
+
+# Mapping set hash: sum of per-mapping digests modulo 2**128, so it is independent of
+# row order and can be updated from just the rows a save touches
+MAPPING_HASH_FIELDS = ('description', 'tea_category', 'gasb_category', 'fund_category', 'statement_line', 'notes')
+MAPPING_HASH_MODULUS = 1 << 128
+
+def mapping_row_digest(account_code: str, values) -> int:
+    """Digest of one stored mapping (values in MAPPING_HASH_FIELDS order)"""
+    payload = json.dumps([account_code, *values], separators=(',', ':'))
+    return int.from_bytes(hashlib.sha256(payload.encode()).digest()[:16], 'big')
+
+def _empty_validation() -> dict:
+    return {'unmapped': 0, 'invalid': 0, 'categories': {}}
+
+def _count_mapping_status(validation: dict, status: str, gasb_category: str, step: int):
+    """Add (step=1) or remove (step=-1) one mapping from the validation counters"""
+    if status != 'mapped':
+        validation[status] += step
+        return
+    categories = validation['categories']
+    categories[gasb_category] = categories.get(gasb_category, 0) + step
+    if not categories[gasb_category]:
+        del categories[gasb_category]
+
+async def _load_mapping_version(cursor, user_id: str) -> tuple:
+    """(hash, count, validation counters) of the user's mapping set, computed from the rows if never recorded"""
+    await cursor.execute("SELECT mapping_hash, mapping_count, validation_json FROM mapping_versions WHERE user_id = ?", (user_id,))
+    result = await cursor.fetchone()
+    if result and result[2]:
+        return int(result[0], 16), result[1], json.loads(result[2])
+    
+    validation = _empty_validation()
+    await cursor.execute('''
+        SELECT validation_status, gasb_category, COUNT(*)
+        FROM account_mappings WHERE user_id = ?
+        GROUP BY validation_status, gasb_category
+    ''', (user_id,))
+    for validation_status, gasb_category, count in await cursor.fetchall():
+        _count_mapping_status(validation, validation_status, gasb_category, count)
+    if result:
+        return int(result[0], 16), result[1], validation
+    
+    await cursor.execute(f'''
+        SELECT account_code, {', '.join(MAPPING_HASH_FIELDS)}
+        FROM account_mappings WHERE user_id = ?
+    ''', (user_id,))
+    rows = await cursor.fetchall()
+    total = sum(mapping_row_digest(row[0], row[1:]) for row in rows) % MAPPING_HASH_MODULUS
+    return total, len(rows), validation
+
+async def _store_mapping_version(cursor, user_id: str, mapping_hash: int, mapping_count: int, validation: dict):
+    await cursor.execute('''
+        INSERT OR REPLACE INTO mapping_versions (user_id, mapping_hash, mapping_count, validation_json, updated_at)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ''', (user_id, f"{mapping_hash:032x}", mapping_count, json.dumps(validation, sort_keys=True)))
+
+async def get_mapping_version(user_id: str) -> dict:
+    """Content hash and size of the user's mapping set, without loading the mappings"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        mapping_hash, mapping_count, _ = await _load_mapping_version(cursor, user_id)
+    return {'mapping_hash': f"{mapping_hash:032x}", 'mapping_count': mapping_count}
+
+async def get_mapping_validation(user_id: str) -> dict:
+    """validate_mapping() of the user's whole mapping set, from the stored counters and the status index"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        _, _, validation = await _load_mapping_version(cursor, user_id)
+        examples = {}
+        for validation_status in ('unmapped', 'invalid'):
+            await cursor.execute('''
+                SELECT account_code FROM account_mappings
+                WHERE user_id = ? AND validation_status = ?
+                ORDER BY account_code
+                LIMIT 10
+            ''', (user_id, validation_status))
+            examples[validation_status] = [row[0] for row in await cursor.fetchall()]
+    
+    return validation_summary(
+        validation['categories'], validation['unmapped'], validation['invalid'], examples['unmapped'], examples['invalid']
+    )
+
+async def save_account_mappings(user_id: str, mappings: dict, replace_existing: bool = True) -> dict:
+    """Save account mappings to database; returns the mapping set hash before and after the save.
+    
+    Rows equal to the stored ones are skipped, so the cost (including the set hash and validation
+    counters) follows the changed rows; `changed_accounts` lists them and `changed_mappings` holds
+    their rows as written by this save (deleted accounts left out). With replace_existing=False,
+    accounts that already have a mapping are left untouched.
+    """
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        # IMMEDIATE so no other save lands between reading the set hash and writing the new one
+        await cursor.execute("BEGIN IMMEDIATE")
+        mapping_hash, mapping_count, validation = await _load_mapping_version(cursor, user_id)
+        previous_hash = mapping_hash
+        
+        rows = []
+        changed = []
+        
+        # If empty mappings dict, delete all mappings for this user
+        if not mappings:
+            await cursor.execute("DELETE FROM account_mappings WHERE user_id = ?", (user_id,))
+            mapping_hash, mapping_count, validation = 0, 0, _empty_validation()
+        else:
+            
+            # Stored rows of the posted accounts: (values, validation status) per account code
+            codes = list(mappings)
+            stored = {}
+            for start in range(0, len(codes), 500):
+                chunk = codes[start:start + 500]
+                await cursor.execute(f'''
+                    SELECT account_code, {', '.join(MAPPING_HASH_FIELDS)}, validation_status
+                    FROM account_mappings
+                    WHERE user_id = ? AND account_code IN ({', '.join('?' * len(chunk))})
+                ''', (user_id, *chunk))
+                for row in await cursor.fetchall():
+                    stored[row[0]] = (tuple(row[1:-1]), row[-1])
+            
+            deletes = []
+            for account_code, mapping_data in mappings.items():
+                if not replace_existing and account_code in stored:
+                    continue
+                if mapping_data is None:
+                    if account_code not in stored:
+                        continue
+                    deletes.append((user_id, account_code))
+                else:
+                    # As the TEXT columns store them, so the digest added now is the one subtracted later
+                    values = tuple(None if value is None else str(value) for value in (
+                        mapping_data.get('description', ''),
+                        mapping_data.get('tea_category', ''),
+                        mapping_data.get('gasb_category', ''),
+                        mapping_data.get('fund_category', ''),
+                        mapping_data.get('statement_line', 'XX'),
+                        mapping_data.get('notes', '')
+                    ))
+                    if account_code in stored and stored[account_code][0] == values:
+                        continue
+                    status = mapping_status(account_code, values[2])
+                    rows.append((user_id, account_code, *values, status))
+                    mapping_hash += mapping_row_digest(account_code, values)
+                    mapping_count += 1
+                    _count_mapping_status(validation, status, values[2], 1)
+                
+                # The replaced or deleted row leaves the set hash and the counters
+                if account_code in stored:
+                    old_values, old_status = stored[account_code]
+                    mapping_hash -= mapping_row_digest(account_code, old_values)
+                    mapping_count -= 1
+                    _count_mapping_status(validation, old_status or mapping_status(account_code, old_values[2]), old_values[2], -1)
+                changed.append(account_code)
+            
+            # One executemany per statement instead of a round trip per account
+            await cursor.executemany("DELETE FROM account_mappings WHERE user_id = ? AND account_code = ?", deletes)
+            await cursor.executemany('''
+                INSERT OR REPLACE INTO account_mappings
+                (user_id, account_code, description, tea_category, gasb_category, fund_category, statement_line, notes, validation_status, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', rows)
+            mapping_hash %= MAPPING_HASH_MODULUS
+        
+        await _store_mapping_version(cursor, user_id, mapping_hash, mapping_count, validation)
+        await conn.commit()
+    
+    return {
+        'previous_hash': f"{previous_hash:032x}",
+        'mapping_hash': f"{mapping_hash:032x}",
+        'mapping_count': mapping_count,
+        'saved_count': len(rows),
+        'changed_accounts': changed,
+        'changed_mappings': {row[1]: _mapping_from_row(row[1:-1]) for row in rows}
+    }
+
+def _mapping_from_row(row) -> dict:
+    return {
+        'account_code': row[0],
+        'description': row[1] or '',
+        'tea_category': row[2] or '',
+        'gasb_category': row[3] or '',
+        'fund_category': row[4] or '',
+        'statement_line': row[5] or 'XX',
+        'notes': row[6] or ''
+    }
+
+async def get_account_mappings_for_codes(user_id: str, account_codes: list) -> dict:
+    """Mappings of just the given account codes (codes without a mapping are left out)"""
+    mappings = {}
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        for start in range(0, len(account_codes), 500):
+            chunk = account_codes[start:start + 500]
+            await cursor.execute(f'''
+                SELECT account_code, description, tea_category, gasb_category, fund_category, statement_line, notes
+                FROM account_mappings
+                WHERE user_id = ? AND account_code IN ({', '.join('?' * len(chunk))})
+            ''', (user_id, *chunk))
+            for row in await cursor.fetchall():
+                mappings[row[0]] = _mapping_from_row(row)
+    
+    return mappings
+
+async def get_all_account_mappings(user_id: str) -> dict:
+    """Every mapping of the user, ordered by account code"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        await cursor.execute('''
+            SELECT account_code, description, tea_category, gasb_category, fund_category, statement_line, notes
+            FROM account_mappings
+            WHERE user_id = ?
+            ORDER BY account_code
+        ''', (user_id,))
+        return {row[0]: _mapping_from_row(row) for row in await cursor.fetchall()}
+
+async def get_mapped_account_codes(user_id: str) -> list:
+    """Account codes the user has a mapping for (read from the (user_id, account_code) index only)"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        await cursor.execute("SELECT account_code FROM account_mappings WHERE user_id = ?", (user_id,))
+        return [row[0] for row in await cursor.fetchall()]
+
+async def get_account_mappings(user_id: str, page: int = 1, page_size: int = 100, search: str = None):
     """Get account mappings from database with pagination"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    # Build search condition
-    search_condition = ""
-    search_params = [user_id]
-    
-    if search:
-        search_lower = search.lower()
-        # GASB category display names mapping
-        gasb_display_names = {
-            'current_assets': 'current assets',
-            'capital_assets': 'capital assets', 
-            'deferred_outflows': 'deferred outflows of resources',
-            'current_liabilities': 'current liabilities',
-            'long_term_liabilities': 'long-term liabilities',
-            'deferred_inflows': 'deferred inflows of resources',
-            'net_investment_capital_assets': 'net investment in capital assets',
-            'restricted_net_position': 'restricted net position',
-            'unrestricted_net_position': 'unrestricted net position',
-            'program_revenues': 'program revenues',
-            'general_revenues': 'general revenues',
-            'program_expenses': 'program expenses',
-            'general_expenses': 'general expenses'
-        }
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
         
-        search_condition = '''
-            AND (
-                LOWER(account_code) LIKE ? OR
-                LOWER(description) LIKE ? OR
-                LOWER(tea_category) LIKE ? OR
-                LOWER(gasb_category) LIKE ? OR
-                LOWER(fund_category) LIKE ?
-            )
+        # Build search condition
+        search_condition = ""
+        search_params = [user_id]
+        
+        if search:
+            search_lower = search.lower()
+            # GASB category display names mapping
+            gasb_display_names = {
+                'current_assets': 'current assets',
+                'capital_assets': 'capital assets', 
+                'deferred_outflows': 'deferred outflows of resources',
+                'current_liabilities': 'current liabilities',
+                'long_term_liabilities': 'long-term liabilities',
+                'deferred_inflows': 'deferred inflows of resources',
+                'net_investment_capital_assets': 'net investment in capital assets',
+                'restricted_net_position': 'restricted net position',
+                'unrestricted_net_position': 'unrestricted net position',
+                'program_revenues': 'program revenues',
+                'general_revenues': 'general revenues',
+                'program_expenses': 'program expenses',
+                'general_expenses': 'general expenses'
+            }
+            
+            search_condition = '''
+                AND (
+                    LOWER(account_code) LIKE ? OR
+                    LOWER(description) LIKE ? OR
+                    LOWER(tea_category) LIKE ? OR
+                    LOWER(gasb_category) LIKE ? OR
+                    LOWER(fund_category) LIKE ?
+                )
+            '''
+            search_params.extend([f'%{search_lower}%'] * 5)
+        
+        # Get total count
+        count_query = f"SELECT COUNT(*) FROM account_mappings WHERE user_id = ? {search_condition}"
+        await cursor.execute(count_query, search_params)
+        total_items = (await cursor.fetchone())[0]
+        
+        # Calculate pagination
+        total_pages = (total_items + page_size - 1) // page_size
+        offset = (page - 1) * page_size
+        
+        # Get paginated results
+        query = f'''
+            SELECT account_code, description, tea_category, gasb_category, fund_category, statement_line, notes
+            FROM account_mappings 
+            WHERE user_id = ? {search_condition}
+            ORDER BY account_code
+            LIMIT ? OFFSET ?
         '''
-        search_params.extend([f'%{search_lower}%'] * 5)
-    
-    # Get total count
-    count_query = f"SELECT COUNT(*) FROM account_mappings WHERE user_id = ? {search_condition}"
-    cursor.execute(count_query, search_params)
-    total_items = cursor.fetchone()[0]
-    
-    # Calculate pagination
-    total_pages = (total_items + page_size - 1) // page_size
-    offset = (page - 1) * page_size
-    
-    # Get paginated results
-    query = f'''
-        SELECT account_code, description, tea_category, gasb_category, fund_category, statement_line, notes
-        FROM account_mappings 
-        WHERE user_id = ? {search_condition}
-        ORDER BY account_code
-        LIMIT ? OFFSET ?
-    '''
-    cursor.execute(query, search_params + [page_size, offset])
-    
-    results = cursor.fetchall()
-    conn.close()
+        await cursor.execute(query, search_params + [page_size, offset])
+        
+        results = await cursor.fetchall()
     
     # Convert to dictionary format
     mappings = {}
     for row in results:
-        mappings[row[0]] = {
-            'account_code': row[0],
-            'description': row[1] or '',
-            'tea_category': row[2] or '',
-            'gasb_category': row[3] or '',
-            'fund_category': row[4] or '',
-            'statement_line': row[5] or 'XX',
-            'notes': row[6] or ''
-        }
+        mappings[row[0]] = _mapping_from_row(row)
     
     return {
         'mappings': mappings,
@@ -299,13 +856,11 @@ def get_account_mappings(user_id: str, page: int = 1, page_size: int = 100, sear
 
 def get_user_by_email(email: str):
     """Get user by email"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
-    user = cursor.fetchone()
-    
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
+        user = cursor.fetchone()
     
     if user:
         return {
@@ -323,33 +878,30 @@ def get_user_by_email(email: str):
 
 def create_user(email: str, password: str, first_name: str = None, last_name: str = None, organization: str = None):
     """Create a new user"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
     user_id = str(uuid.uuid4())
     hashed_password = pwd_context.hash(password)
     
     try:
-        cursor.execute('''
-            INSERT INTO users (id, email, hashed_password, first_name, last_name, organization)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, email, hashed_password, first_name, last_name, organization))
-        
-        conn.commit()
-        conn.close()
-        
-        return {
-            "id": user_id,
-            "email": email,
-            "first_name": first_name,
-            "last_name": last_name,
-            "organization": organization,
-            "is_active": True,
-            "is_verified": False
-        }
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO users (id, email, hashed_password, first_name, last_name, organization)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, email, hashed_password, first_name, last_name, organization))
+            
+            conn.commit()
     except sqlite3.IntegrityError:
-        conn.close()
         raise HTTPException(status_code=400, detail="User with this email already exists")
+    
+    return {
+        "id": user_id,
+        "email": email,
+        "first_name": first_name,
+        "last_name": last_name,
+        "organization": organization,
+        "is_active": True,
+        "is_verified": False
+    }
 
 def verify_password(plain_password: str, hashed_password: str):
     """Verify a password"""
@@ -403,8 +955,10 @@ async def register(user_data: UserCreate):
             detail="Password must be at least 8 characters long"
         )
     
-    # Create user
-    user = create_user(
+    # Create user (off the event loop: a sync write waiting there for the lock would stall the
+    # async transaction holding it, e.g. a job worker's claim, until the busy timeout)
+    user = await asyncio.to_thread(
+        create_user,
         email=user_data.email,
         password=user_data.password,
         first_name=user_data.first_name,
@@ -439,97 +993,525 @@ async def login(username: str = Form(...), password: str = Form(...)):
     
     return {"access_token": access_token, "token_type": "bearer"}
 
-def save_financial_statements(user_id: str, statement_type: str, statement_data: dict):
-    """Save financial statements to database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
+async def save_financial_statements(user_id: str, statement_type: str, statement_data: dict, cache_key: str = None, line_assignment: bytes = None):
+    """Save financial statements to database, replacing the user's previous ones of that type"""
+    statement_json = await asyncio.to_thread(json.dumps, statement_data)
     
-    cursor.execute('''
-        INSERT OR REPLACE INTO financial_statements 
-        (user_id, statement_type, statement_data, created_at)
-        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (user_id, statement_type, json.dumps(statement_data)))
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await cursor.execute("DELETE FROM financial_statements WHERE user_id = ? AND statement_type = ?", (user_id, statement_type))
+        await cursor.execute('''
+            INSERT INTO financial_statements
+            (user_id, statement_type, statement_data, cache_key, line_assignment, created_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (user_id, statement_type, statement_json, cache_key, line_assignment))
+        
+        await conn.commit()
+
+async def replace_financial_statements(user_id: str, statement_type: str, statement_data: dict, cache_key: str, line_assignment: bytes, expected_cache_key: str) -> bool:
+    """Overwrite stored statements only if they still carry expected_cache_key; returns whether they did"""
+    statement_json = await asyncio.to_thread(json.dumps, statement_data)
+    
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await cursor.execute('''
+            UPDATE financial_statements
+            SET statement_data = ?, cache_key = ?, line_assignment = ?, created_at = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND statement_type = ? AND cache_key = ?
+        ''', (statement_json, cache_key, line_assignment, user_id, statement_type, expected_cache_key))
+        replaced = cursor.rowcount > 0
+        
+        await conn.commit()
     
-    conn.commit()
-    conn.close()
+    return replaced
 
-def get_financial_statements(user_id: str, statement_type: str):
+async def get_financial_statements(user_id: str, statement_type: str):
     """Get financial statements from database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT statement_data, created_at
-        FROM financial_statements 
-        WHERE user_id = ? AND statement_type = ?
-        ORDER BY created_at DESC
-        LIMIT 1
-    ''', (user_id, statement_type))
-    
-    result = cursor.fetchone()
-    conn.close()
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await cursor.execute('''
+            SELECT statement_data, created_at, cache_key, line_assignment
+            FROM financial_statements
+            WHERE user_id = ? AND statement_type = ?
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', (user_id, statement_type))
+        
+        result = await cursor.fetchone()
     
     if result:
         return {
             'statements_json': json.loads(result[0]),
+            'cache_key': result[2],
+            'line_assignment': result[3],
             'created_at': result[1]
         }
     return None
 
-def save_audit_trail(user_id: str, audit_data: list, total_records: int):
-    """Save audit trail data to database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT OR REPLACE INTO audit_trails 
-        (user_id, audit_data, total_records, created_at)
-        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (user_id, json.dumps(audit_data), total_records))
-    
-    conn.commit()
-    conn.close()
+# Audit trail record fields, in order
+AUDIT_TRAIL_COLUMNS = [
+    'account_code', 'current_year_actual', 'budget', 'prior_year_actual',
+    'fund_code', 'function_code', 'object_code', 'sub_object_code', 'location_code', 'unmapped_accounts',
+    'tea_category', 'gasb_category', 'fund_category',
+    'statement_type', 'statement_section', 'statement_line_code', 'statement_line_description',
+    'mapping_method', 'mapping_confidence', 'processing_notes', 'rollup_applied', 'rollup_description',
+    'file_upload_date', 'processing_timestamp', 'user_id', 'version'
+]
+# Fields that are the same for every record of a build, stored once in audit_runs
+AUDIT_RUN_COLUMNS = ('file_upload_date', 'processing_timestamp', 'user_id', 'version')
+# Fields stored as audit_trail_rows columns
+AUDIT_ROW_COLUMNS = [column for column in AUDIT_TRAIL_COLUMNS if column not in AUDIT_RUN_COLUMNS]
+AUDIT_TRAIL_BOOLEAN_COLUMNS = ('unmapped_accounts', 'rollup_applied')
+AUDIT_TRAIL_FILTER_COLUMNS = ('unmapped_accounts', 'gasb_category', 'fund_code', 'function_code', 'statement_line_code', 'rollup_applied')
+AUDIT_RUNS_KEPT = int(os.getenv("AUDIT_RUNS_KEPT", "1"))  # Most recent audit runs kept per user; older ones are pruned on save
+# Fills in a run's summary counts from its rows (parameters: the run id, four times)
+AUDIT_RUN_SUMMARY_SQL = '''
+    UPDATE audit_runs SET
+        total_records = (SELECT COUNT(*) FROM audit_trail_rows WHERE run_id = ?),
+        unmapped_records = (SELECT COUNT(*) FROM audit_trail_rows WHERE run_id = ? AND unmapped_accounts = 1),
+        unmapped_amount = (SELECT COALESCE(SUM(ABS(current_year_actual)), 0)
+                           FROM audit_trail_rows WHERE run_id = ? AND unmapped_accounts = 1)
+    WHERE id = ?
+'''
 
-def get_audit_trail(user_id: str):
-    """Get audit trail data from database"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT audit_data, total_records, created_at
-        FROM audit_trails 
+def _migrate_legacy_audit_trails(cursor):
+    """Move the audit trails stored as one JSON blob per build (audit_trails) into audit runs: the latest blob per user"""
+    tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'audit_trails' in tables:
+        row_columns = ', '.join(AUDIT_ROW_COLUMNS)
+        for (user_id,) in cursor.execute("SELECT DISTINCT user_id FROM audit_trails").fetchall():
+            cursor.execute('''
+                SELECT audit_data FROM audit_trails WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT 1
+            ''', (user_id,))
+            records = json.loads(cursor.fetchone()[0])
+            run = records[0] if records else {}
+            cursor.execute('''
+                INSERT INTO audit_runs (user_id, version, file_upload_date, processing_timestamp)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, run.get('version'), run.get('file_upload_date'), run.get('processing_timestamp')))
+            run_id = cursor.lastrowid
+            cursor.executemany(f'''
+                INSERT INTO audit_trail_rows (run_id, row_index, {row_columns})
+                VALUES ({', '.join('?' * (len(AUDIT_ROW_COLUMNS) + 2))})
+            ''', ((run_id, index, *(record.get(column) for column in AUDIT_ROW_COLUMNS)) for index, record in enumerate(records)))
+            cursor.execute(AUDIT_RUN_SUMMARY_SQL, (run_id,) * 4)
+        cursor.execute("DROP TABLE audit_trails")
+
+async def _prune_audit_runs(cursor, user_id: str, keep: int):
+    """Delete all but the user's keep most recent audit runs, with their rows"""
+    await cursor.execute(
+        "SELECT id FROM audit_runs WHERE user_id = ? ORDER BY id DESC LIMIT -1 OFFSET ?", (user_id, keep)
+    )
+    stale = await cursor.fetchall()
+    await cursor.executemany("DELETE FROM audit_trail_rows WHERE run_id = ?", stale)
+    await cursor.executemany("DELETE FROM audit_runs WHERE id = ?", stale)
+
+async def _latest_audit_run(cursor, user_id: str) -> Optional[dict]:
+    """The user's most recent audit run row, or None"""
+    await cursor.execute('''
+        SELECT id, file_upload_date, processing_timestamp, version, total_records, unmapped_records, unmapped_amount,
+            cache_key, created_at
+        FROM audit_runs
         WHERE user_id = ?
-        ORDER BY created_at DESC
+        ORDER BY id DESC
         LIMIT 1
     ''', (user_id,))
+    result = await cursor.fetchone()
+    if not result:
+        return None
+    run = dict(zip(('id', 'file_upload_date', 'processing_timestamp', 'version',
+                    'total_records', 'unmapped_records', 'unmapped_amount', 'cache_key', 'created_at'), result))
+    run['user_id'] = user_id
+    return run
+
+def _audit_run_summary(run: dict) -> dict:
+    """Summary counts of an audit run, as the audit trail endpoints return them"""
+    return {
+        'total_records': run['total_records'],
+        'mapped_records': run['total_records'] - run['unmapped_records'],
+        'unmapped_records': run['unmapped_records'],
+        'unmapped_amount': run['unmapped_amount']
+    }
+
+async def save_audit_trail(user_id: str, run: dict, rows, cache_key: str = None) -> int:
+    """Save an audit trail as a new run and prune the user's older runs; returns the run id.
     
-    result = cursor.fetchone()
-    conn.close()
+    run holds the AUDIT_RUN_COLUMNS values shared by every record, rows the records as tuples in
+    AUDIT_ROW_COLUMNS order. cache_key identifies the inputs the run was built from (None: never reused).
+    """
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await cursor.execute('''
+            INSERT INTO audit_runs (user_id, version, file_upload_date, processing_timestamp, cache_key)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, run.get('version'), run.get('file_upload_date'), run.get('processing_timestamp'), cache_key))
+        run_id = cursor.lastrowid
+        await cursor.executemany(f'''
+            INSERT INTO audit_trail_rows (run_id, row_index, {', '.join(AUDIT_ROW_COLUMNS)})
+            VALUES ({', '.join('?' * (len(AUDIT_ROW_COLUMNS) + 2))})
+        ''', ((run_id, index, *values) for index, values in enumerate(rows)))
+        
+        # Summary counts are computed once here, so reads don't rescan the rows
+        await cursor.execute(AUDIT_RUN_SUMMARY_SQL, (run_id,) * 4)
+        
+        await _prune_audit_runs(cursor, user_id, max(AUDIT_RUNS_KEPT, 1))
+        await conn.commit()
     
-    if result:
-        return {
-            'audit_data': json.loads(result[0]),
-            'total_records': result[1],
-            'created_at': result[2]
-        }
-    return None
+    return run_id
+
+async def get_audit_trail_rows(user_id: str, filters: dict, sort: str = 'row_index', descending: bool = False,
+                               columns: Optional[list] = None, page: int = 1, page_size: int = 100,
+                               after: Optional[list] = None) -> dict:
+    """One page of the latest audit run, filtered and sorted in SQL (an empty page when nothing is stored).
+    
+    filters maps AUDIT_TRAIL_FILTER_COLUMNS to a required value (None: no filter). With after, the
+    keyset (sort value, row_index) of the previous page's last row, page is ignored. NULL sort values
+    (legacy runs) come first, as SQLite orders them.
+    """
+    columns = columns or AUDIT_TRAIL_COLUMNS
+    stored = [column for column in columns if column not in AUDIT_RUN_COLUMNS]
+    order_by = ['row_index'] if sort == 'row_index' else [sort, 'row_index']
+    direction = 'DESC' if descending else 'ASC'
+    
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        run = await _latest_audit_run(cursor, user_id)
+        if not run:
+            run = {'id': None, 'total_records': 0, 'unmapped_records': 0, 'unmapped_amount': 0}
+        
+        conditions = ['run_id = ?']
+        params = [run['id']]
+        for column, value in filters.items():
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(int(value) if column in AUDIT_TRAIL_BOOLEAN_COLUMNS else value)
+        
+        where = ' AND '.join(conditions)
+        await cursor.execute(f"SELECT COUNT(*) FROM audit_trail_rows WHERE {where}", params)
+        total_items = (await cursor.fetchone())[0]
+        
+        offset = (page - 1) * page_size
+        segments = [('', [])]
+        if after is not None:
+            segments = _audit_keyset_segments(order_by, descending, after)
+            offset = 0
+        
+        # One extra row tells whether another page follows; each segment is an index range of its own
+        results = []
+        for condition, keys in segments:
+            await cursor.execute(f'''
+                SELECT {', '.join(order_by + stored)}
+                FROM audit_trail_rows
+                WHERE {where}{condition}
+                ORDER BY {', '.join(f"{column} {direction}" for column in order_by)}
+                LIMIT ? OFFSET ?
+            ''', params + keys + [page_size + 1 - len(results), offset])
+            results += await cursor.fetchall()
+            if len(results) > page_size:
+                break
+    
+    records = []
+    for row in results[:page_size]:
+        values = dict(zip(stored, row[len(order_by):]))
+        record = {'row': row[len(order_by) - 1]}
+        for column in columns:
+            value = run[column] if column in AUDIT_RUN_COLUMNS else values[column]
+            record[column] = bool(value) if column in AUDIT_TRAIL_BOOLEAN_COLUMNS and value is not None else value
+        records.append(record)
+    
+    return {
+        'records': records,
+        'total_items': total_items,
+        'next_key': list(results[page_size - 1][:len(order_by)]) if len(results) > page_size else None,
+        'summary': _audit_run_summary(run)
+    }
+
+def _audit_keyset_segments(order_by: list, descending: bool, after: list) -> list:
+    """(condition, parameters) of the rows past the keyset after, as consecutive ranges in sort order.
+    
+    A row-value comparison with NULL is NULL, so NULL sort values (first ascending, last descending)
+    get a range of their own instead of a COALESCE that would keep the column index from being used.
+    """
+    if len(order_by) == 1 or after[0] is not None:
+        keys = ', '.join(order_by)
+        marks = ', '.join('?' * len(order_by))
+        segments = [(f" AND ({keys}) {'<' if descending else '>'} ({marks})", list(after))]
+        if len(order_by) > 1 and descending:
+            segments.append((f" AND {order_by[0]} IS NULL", []))
+        return segments
+    
+    sort = order_by[0]
+    segments = [(f" AND {sort} IS NULL AND row_index {'<' if descending else '>'} ?", [after[1]])]
+    if not descending:
+        segments.append((f" AND {sort} IS NOT NULL", []))
+    return segments
+
+def _audit_run_records(run: dict, results: list) -> list:
+    """Full audit trail records from stored rows, with the run-level fields filled back in"""
+    records = []
+    for row in results:
+        values = dict(zip(AUDIT_ROW_COLUMNS, row))
+        for column in AUDIT_TRAIL_BOOLEAN_COLUMNS:
+            if values[column] is not None:
+                values[column] = bool(values[column])
+        records.append({column: run[column] if column in AUDIT_RUN_COLUMNS else values[column]
+                        for column in AUDIT_TRAIL_COLUMNS})
+    return records
+
+async def get_audit_run(user_id: str, cache_key: str = None) -> Optional[dict]:
+    """The user's latest audit run (metadata and summary, no rows); None if there is none or it was built for another cache_key"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        run = await _latest_audit_run(cursor, user_id)
+    
+    if not run or (cache_key is not None and run['cache_key'] != cache_key):
+        return None
+    run['summary'] = _audit_run_summary(run)
+    return run
+
+@asynccontextmanager
+async def audit_run_snapshot(user_id: str, cache_key: str = None):
+    """Yield (cursor, latest audit run as get_audit_run() returns it, or None) inside one read transaction.
+    
+    Everything read through the cursor comes from the same snapshot, so a newer run pruning this one
+    meanwhile cannot cut a reader short. The connection is held until the block exits.
+    """
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        await cursor.execute("BEGIN")
+        run = await _latest_audit_run(cursor, user_id)
+        if not run or (cache_key is not None and run['cache_key'] != cache_key):
+            run = None
+        else:
+            run['summary'] = _audit_run_summary(run)
+        yield cursor, run
+
+async def iter_audit_run_records(cursor, run: dict, chunk_rows: int):
+    """Yield the full records of a stored audit run in row order, chunk_rows at a time (cursor: from audit_run_snapshot())"""
+    last_index = -1
+    while True:
+        await cursor.execute(f'''
+            SELECT row_index, {', '.join(AUDIT_ROW_COLUMNS)}
+            FROM audit_trail_rows
+            WHERE run_id = ? AND row_index > ?
+            ORDER BY row_index
+            LIMIT ?
+        ''', (run['id'], last_index, chunk_rows))
+        results = await cursor.fetchall()
+        if not results:
+            break
+        last_index = results[-1][0]
+        yield await asyncio.to_thread(_audit_run_records, run, [row[1:] for row in results])
+
+async def get_audit_trail(user_id: str, cache_key: str = None):
+    """Get the latest audit run from database, as full records (None if there is none or it was built for another cache_key)"""
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        run = await _latest_audit_run(cursor, user_id)
+        if not run or (cache_key is not None and run['cache_key'] != cache_key):
+            return None
+        await cursor.execute(f'''
+            SELECT {', '.join(AUDIT_ROW_COLUMNS)}
+            FROM audit_trail_rows
+            WHERE run_id = ?
+            ORDER BY row_index
+        ''', (run['id'],))
+        results = await cursor.fetchall()
+    
+    return {
+        'audit_data': await asyncio.to_thread(_audit_run_records, run, results),
+        'total_records': run['total_records'],
+        'summary': _audit_run_summary(run),
+        'run': run,
+        'created_at': run['created_at']
+    }
 
-def clear_audit_trail(user_id: str):
+async def clear_audit_trail(user_id: str):
     """Clear audit trail data for a user"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
+    async with async_db_connection() as conn:
+        cursor = await conn.cursor()
+        
+        await _prune_audit_runs(cursor, user_id, 0)
+        
+        await conn.commit()
+
+# Background job persistence (see job_queue.py)
+JOB_COLUMNS = '''id, user_id, kind, status, progress, message, params, result, error,
+    artifact_path, artifact_name, artifact_media_type, attempts, created_at, started_at, finished_at'''
+
+def _job_from_row(row) -> dict:
+    return {
+        'id': row[0],
+        'user_id': row[1],
+        'kind': row[2],
+        'status': row[3],
+        'progress': row[4],
+        'message': row[5],
+        'params': json.loads(row[6]) if row[6] else {},
+        'result': json.loads(row[7]) if row[7] else None,
+        'error': row[8],
+        'artifact_path': row[9],
+        'artifact_name': row[10],
+        'artifact_media_type': row[11],
+        'attempts': row[12],
+        'created_at': row[13],
+        'started_at': row[14],
+        'finished_at': row[15]
+    }
+
+async def create_job(user_id: str, kind: str, params: dict) -> dict:
+    """Queue a background job and return it"""
+    job_id = str(uuid.uuid4())
     
-    cursor.execute('''
-        DELETE FROM audit_trails WHERE user_id = ?
-    ''', (user_id,))
+    async with async_db_connection() as conn:
+        await conn.execute('''
+            INSERT INTO jobs (id, user_id, kind, status, progress, message, params)
+            VALUES (?, ?, ?, 'queued', 0, 'Queued', ?)
+        ''', (job_id, user_id, kind, json.dumps(params)))
+        await conn.commit()
+    
+    return await get_job(job_id)
+
+async def get_job(job_id: str, user_id: str = None):
+    """Get a job by id (optionally restricted to its owner)"""
+    async with async_db_connection() as conn:
+        if user_id is None:
+            cursor = await conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,))
+        else:
+            cursor = await conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = ? AND user_id = ?", (job_id, user_id))
+        row = await cursor.fetchone()
     
-    conn.commit()
-    conn.close()
+    return _job_from_row(row) if row else None
+
+async def list_jobs(user_id: str, limit: int = 50) -> list:
+    """Most recent jobs for a user"""
+    async with async_db_connection() as conn:
+        cursor = await conn.execute(f'''
+            SELECT {JOB_COLUMNS} FROM jobs
+            WHERE user_id = ?
+            ORDER BY created_at DESC, rowid DESC
+            LIMIT ?
+        ''', (user_id, limit))
+        rows = await cursor.fetchall()
+    
+    return [_job_from_row(row) for row in rows]
+
+async def claim_next_job(worker_id: str, lease_seconds: int, max_attempts: int):
+    """Atomically move the oldest runnable job to 'running' for this worker.
+    
+    Runnable means queued, or running under a worker whose heartbeat is older than the lease
+    (the process died mid-job). Jobs that already used up max_attempts are failed instead.
+    """
+    stale_before = f"-{int(lease_seconds)} seconds"
+    
+    async with async_db_connection() as conn:
+        # IMMEDIATE takes the write lock up front so two workers cannot claim the same row
+        await conn.execute("BEGIN IMMEDIATE")
+        await conn.execute('''
+            UPDATE jobs
+            SET status = 'failed', error = 'Job was interrupted too many times', finished_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND heartbeat_at < datetime('now', ?) AND attempts >= ?
+        ''', (stale_before, max_attempts))
+        cursor = await conn.execute('''
+            SELECT id FROM jobs
+            WHERE status = 'queued'
+               OR (status = 'running' AND heartbeat_at < datetime('now', ?))
+            ORDER BY created_at, rowid
+            LIMIT 1
+        ''', (stale_before,))
+        row = await cursor.fetchone()
+        if row is None:
+            await conn.commit()
+            return None
+        await conn.execute('''
+            UPDATE jobs
+            SET status = 'running', worker_id = ?, attempts = attempts + 1, error = NULL,
+                heartbeat_at = CURRENT_TIMESTAMP, started_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (worker_id, row[0]))
+        await conn.commit()
+    
+    return await get_job(row[0])
+
+# The updates below only apply while worker_id still holds the job: once its lease expired and another
+# worker re-claimed it, the original worker's late writes are dropped (they return False)
+async def update_job_progress(job_id: str, worker_id: str, progress: int, message: str = None) -> bool:
+    """Record progress (0-100) for a running job; also refreshes its heartbeat"""
+    async with async_db_connection() as conn:
+        cursor = await conn.execute('''
+            UPDATE jobs SET progress = ?, message = COALESCE(?, message), heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running' AND worker_id = ?
+        ''', (progress, message, job_id, worker_id))
+        await conn.commit()
+    return cursor.rowcount == 1
+
+async def touch_job(job_id: str, worker_id: str) -> bool:
+    """Refresh a running job's heartbeat so other workers leave it alone"""
+    async with async_db_connection() as conn:
+        cursor = await conn.execute(
+            "UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running' AND worker_id = ?",
+            (job_id, worker_id)
+        )
+        await conn.commit()
+    return cursor.rowcount == 1
+
+async def finish_job(job_id: str, worker_id: str, result=None, artifact_path: str = None, artifact_name: str = None, artifact_media_type: str = None) -> bool:
+    """Mark a job succeeded and attach its result/artifact"""
+    async with async_db_connection() as conn:
+        cursor = await conn.execute('''
+            UPDATE jobs
+            SET status = 'succeeded', progress = 100, message = 'Completed', result = ?,
+                artifact_path = ?, artifact_name = ?, artifact_media_type = ?, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running' AND worker_id = ?
+        ''', (json.dumps(result) if result is not None else None, artifact_path, artifact_name, artifact_media_type, job_id, worker_id))
+        await conn.commit()
+    return cursor.rowcount == 1
+
+async def fail_job(job_id: str, worker_id: str, error: str) -> bool:
+    """Mark a job failed with an error message"""
+    async with async_db_connection() as conn:
+        cursor = await conn.execute('''
+            UPDATE jobs SET status = 'failed', error = ?, message = 'Failed', finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'running' AND worker_id = ?
+        ''', (error, job_id, worker_id))
+        await conn.commit()
+    return cursor.rowcount == 1
+
+async def requeue_job(job_id: str, worker_id: str, message: str) -> bool:
+    """Put a running job back on the queue (worker shutting down or temporarily saturated)"""
+    async with async_db_connection() as conn:
+        cursor = await conn.execute('''
+            UPDATE jobs SET status = 'queued', worker_id = NULL, attempts = MAX(attempts - 1, 0), message = ?
+            WHERE id = ? AND status = 'running' AND worker_id = ?
+        ''', (message, job_id, worker_id))
+        await conn.commit()
+    return cursor.rowcount == 1
+
+async def list_finished_jobs(status: str = None, finished_before_seconds: int = 0) -> list:
+    """Succeeded or failed jobs (or only those with status) that finished at least finished_before_seconds ago"""
+    async with async_db_connection() as conn:
+        cursor = await conn.execute(f'''
+            SELECT {JOB_COLUMNS} FROM jobs
+            WHERE status IN ('succeeded', 'failed') AND (? IS NULL OR status = ?)
+              AND finished_at <= datetime('now', ?)
+        ''', (status, status, f"-{int(finished_before_seconds)} seconds"))
+        rows = await cursor.fetchall()
+    
+    return [_job_from_row(row) for row in rows]
+
+async def delete_jobs(job_ids: list):
+    """Delete job rows"""
+    async with async_db_connection() as conn:
+        await conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+        await conn.commit()
 
 @router.get("/me", response_model=UserRead)
 async def read_users_me(current_user: dict = Depends(get_current_user)):
     """Get current user"""
     return UserRead(**current_user)
-
-# Initialize database
-init_db()
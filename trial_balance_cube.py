@@ -0,0 +1,92 @@
+"""
+Aggregate cube of a trial balance by TEA account code components
+
+Built once at upload: every trial balance line is rolled up into one cell per distinct
+fund x function x object combination (optionally sub-object and location as well), with the
+amount columns summed and the contributing lines counted. Aggregate and drill-down queries then
+read a few thousand cells instead of re-scanning hundreds of thousands of rows.
+"""
+
+import io
+import os
+import numpy as np
+import pandas as pd
+from mapping_rules import ACCOUNT_CODE_COMPONENTS
+
+CUBE_DIMENSION_NAMES = [name for name, _, _ in ACCOUNT_CODE_COMPONENTS]
+# Dimensions kept in the stored cube (override via environment, e.g. add sub_object_code,location_code)
+CUBE_DIMENSIONS = [
+    name.strip() for name in os.getenv("TB_CUBE_DIMENSIONS", "fund_code,function_code,object_code").split(",") if name.strip()
+]
+CUBE_COUNT_COLUMN = "line_count"
+
+# Same fallback as mapping_rules.get_account_components() for codes that are not valid TEA codes
+INVALID_CODE_COMPONENTS = {'fund_code': '000', 'function_code': '00', 'object_code': '0000'}
+
+def build_cube(df: pd.DataFrame, dimensions: list = None) -> pd.DataFrame:
+    """Sum the trial balance amount columns per distinct combination of code components"""
+    dimensions = dimensions or CUBE_DIMENSIONS
+    unknown = [name for name in dimensions if name not in CUBE_DIMENSION_NAMES]
+    if unknown:
+        raise ValueError(f"Unknown cube dimensions: {', '.join(unknown)}")
+
+    codes = df['account_code'].astype(str)
+    # get_account_components(): at least 9 characters with numeric fund, function and object
+    valid = (codes.str.len() >= 9) & codes.str.slice(0, 9).str.isdigit()
+    columns = {}
+    for name, start, stop in ACCOUNT_CODE_COMPONENTS:
+        if name in dimensions:
+            component = codes.str.slice(start, stop)
+            if name in INVALID_CODE_COMPONENTS:
+                component = component.where(valid, INVALID_CODE_COMPONENTS[name])
+            columns[name] = component.to_numpy(dtype=object)
+    for measure in df.columns[1:]:
+        columns[measure] = pd.to_numeric(df[measure], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    columns[CUBE_COUNT_COLUMN] = np.ones(len(df), dtype=np.int64)
+
+    frame = pd.DataFrame(columns)
+    dimensions = [name for name in CUBE_DIMENSION_NAMES if name in dimensions]
+    return frame.groupby(dimensions, sort=True).sum().reset_index()
+
+def cube_dimensions(cube: pd.DataFrame) -> list:
+    return [name for name in CUBE_DIMENSION_NAMES if name in cube.columns]
+
+def cube_measures(cube: pd.DataFrame) -> list:
+    return [col for col in cube.columns if col not in CUBE_DIMENSION_NAMES and col != CUBE_COUNT_COLUMN]
+
+def rollup_cube(cube: pd.DataFrame, dimensions: list, filters: dict = None) -> pd.DataFrame:
+    """Re-aggregate a stored cube to a subset of its dimensions.
+
+    filters maps a dimension to a code prefix ('61' keeps objects 6100-6199); filters may use any
+    dimension of the cube, including ones rolled away.
+    """
+    missing = [name for name in list(dimensions) + list(filters or {}) if name not in cube.columns]
+    if missing:
+        raise ValueError(f"Cube has no dimension {', '.join(missing)} (available: {', '.join(cube_dimensions(cube))})")
+
+    for name, prefix in (filters or {}).items():
+        cube = cube[cube[name].str.startswith(prefix)]
+    values = cube_measures(cube) + [CUBE_COUNT_COLUMN]
+    if not dimensions:
+        return pd.DataFrame({col: [cube[col].sum()] for col in values})
+    dimensions = [name for name in CUBE_DIMENSION_NAMES if name in dimensions]
+    return cube.groupby(dimensions, sort=True)[values].sum().reset_index()
+
+def cube_to_blob(cube: pd.DataFrame) -> bytes:
+    """Serialize a cube to typed NumPy arrays (one per column) in an .npz blob"""
+    arrays = {}
+    for col in cube.columns:
+        if col in CUBE_DIMENSION_NAMES:
+            arrays[col] = cube[col].to_numpy(dtype=str)
+        else:
+            arrays[col] = cube[col].to_numpy()
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+def cube_from_blob(blob: bytes) -> pd.DataFrame:
+    with np.load(io.BytesIO(blob), allow_pickle=False) as arrays:
+        return pd.DataFrame({
+            col: arrays[col].astype(object) if col in CUBE_DIMENSION_NAMES else arrays[col]
+            for col in arrays.files
+        })